@@ -0,0 +1,330 @@
+"""Cold storage for old orders.
+
+Orders older than a configurable age are copied out of MongoDB into
+zstd-compressed Parquet files partitioned by month
+(orders/year=YYYY/month=MM/part-*.parquet) on the local filesystem or S3,
+then removed from the `orders` collection. The `archive_state` document
+records the watermark: everything created before it lives in the archive,
+everything after it in MongoDB. GET /api/orders reads through
+OrderArchive.read() unless its range starts after the watermark; newest-first
+listings that MongoDB can fill on their own skip it too.
+Each run writes a month into as few files as possible (up to FILE_ROWS
+orders each), sorted by buyer and split into ROW_GROUP_SIZE-row groups.
+Reads open the files seekably and fetch just the footer and the row groups
+whose buyer_id statistics can match, so a buyer's history costs a few
+ranged reads rather than whole partitions. Every run adds files, so run it
+about once a month rather than daily.
+
+Run the job (e.g. from cron) with:
+
+    python archive.py --older-than-days 365
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Small groups keep each group's buyer_id range narrow, so a lookup skips
+# most of a file; large files keep the number of footers to read down.
+ROW_GROUP_SIZE = 5_000
+FILE_ROWS = 250_000
+PARTITION_RE = re.compile(r"year=(\d{4})/month=(\d{2})/")
+
+
+class LocalArchiveStore:
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def list(self, prefix: str):
+        base = self.root / prefix
+        if not base.is_dir():
+            return []
+        return sorted(str(p.relative_to(self.root)) for p in base.rglob("*.parquet"))
+
+    def open(self, key: str):
+        return open(self.root / key, "rb")
+
+    def write(self, key: str, data: bytes):
+        path = self.root / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename so readers never see a half-written file
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(data)
+        tmp.replace(path)
+
+
+class S3ArchiveStore:
+    def __init__(self, bucket: str, prefix: str = ""):
+        import boto3
+        self.s3 = boto3.client("s3")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self._fs = None
+
+    def _key(self, key: str):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def list(self, prefix: str):
+        keys = []
+        strip = len(self.prefix) + 1 if self.prefix else 0
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(prefix)):
+            for obj in page.get("Contents", []):
+                if obj["Key"].endswith(".parquet"):
+                    keys.append(obj["Key"][strip:])
+        return sorted(keys)
+
+    def open(self, key: str):
+        # pyarrow's S3 files are seekable and turn reads into ranged GETs
+        if self._fs is None:
+            from pyarrow import fs
+            self._fs, _ = fs.FileSystem.from_uri(f"s3://{self.bucket}")
+        return self._fs.open_input_file(f"{self.bucket}/{self._key(key)}")
+
+    def write(self, key: str, data: bytes):
+        self.s3.put_object(Bucket=self.bucket, Key=self._key(key), Body=data)
+
+
+def open_archive_store(url: str):
+    # "s3://bucket/prefix", "file:///path" or a plain path
+    if url.startswith("s3://"):
+        bucket, _, prefix = url[len("s3://"):].partition("/")
+        return S3ArchiveStore(bucket, prefix)
+    if url.startswith("file://"):
+        url = url[len("file://"):]
+    return LocalArchiveStore(url)
+
+
+def partition_key(year: int, month: int):
+    return f"orders/year={year:04d}/month={month:02d}/part-{datetime.utcnow():%Y%m%dT%H%M%S%f}.parquet"
+
+
+def month_overlaps(key: str, start: Optional[datetime], end: Optional[datetime]):
+    match = PARTITION_RE.search(key)
+    if not match:
+        return False
+    year, month = int(match.group(1)), int(match.group(2))
+    month_start = datetime(year, month, 1)
+    month_end = datetime(year + month // 12, month % 12 + 1, 1)
+    return (start is None or start < month_end) and (end is None or end > month_start)
+
+
+def orders_table(orders: List[dict]):
+    import pyarrow as pa
+
+    return pa.table({
+        "_id": pa.array([str(o["_id"]) for o in orders], pa.string()),
+        "buyer_id": pa.array([o.get("buyer_id") for o in orders], pa.string()),
+        "buyer_name": pa.array([o.get("buyer_name") for o in orders], pa.string()),
+        # Line items are free-form dicts; keep them as JSON text
+        "items": pa.array([json.dumps(o.get("items", []), default=str) for o in orders], pa.string()),
+        "total": pa.array([float(o.get("total") or 0) for o in orders], pa.float64()),
+        "status": pa.array([o.get("status") for o in orders], pa.string()),
+        "created_at": pa.array([o["created_at"] for o in orders], pa.timestamp("ms")),
+    })
+
+
+def encode_tables(tables):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Sorting by buyer keeps row-group statistics tight, so reads for one
+    # buyer can skip most of a file.
+    table = pa.concat_tables(tables).sort_by([("buyer_id", "ascending"), ("created_at", "ascending")])
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression="zstd", row_group_size=ROW_GROUP_SIZE)
+    return buffer.getvalue()
+
+
+def encode_orders(orders: List[dict]):
+    return encode_tables([orders_table(orders)])
+
+
+def matching_row_groups(metadata, column: str, value):
+    index = metadata.schema.names.index(column)
+    groups = []
+    for i in range(metadata.num_row_groups):
+        stats = metadata.row_group(i).column(index).statistics
+        if stats is None or not stats.has_min_max or stats.min <= value <= stats.max:
+            groups.append(i)
+    return groups
+
+
+def decode_orders(source, buyer_id: str, start: Optional[datetime], end: Optional[datetime]):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    # Opening reads the footer only; row groups are fetched on demand
+    parquet = pq.ParquetFile(source)
+    groups = matching_row_groups(parquet.metadata, "buyer_id", buyer_id)
+    if not groups:
+        return []
+    table = parquet.read_row_groups(groups)
+
+    mask = pc.equal(table["buyer_id"], buyer_id)
+    if start:
+        mask = pc.and_(mask, pc.greater_equal(table["created_at"], pa.scalar(start, pa.timestamp("ms"))))
+    if end:
+        mask = pc.and_(mask, pc.less(table["created_at"], pa.scalar(end, pa.timestamp("ms"))))
+
+    return [
+        {
+            "id": row["_id"],
+            "buyer_id": row["buyer_id"],
+            "buyer_name": row["buyer_name"],
+            "items": json.loads(row["items"]),
+            "total": row["total"],
+            "status": row["status"],
+            "created_at": row["created_at"],
+        }
+        for row in table.filter(mask).to_pylist()
+    ]
+
+
+class OrderArchive:
+    def __init__(self, store, cache_seconds: float = 60):
+        self.store = store
+        self.cache_seconds = cache_seconds
+        self._watermark = None
+        self._watermark_at = None
+        self._keys = None
+
+    async def archived_before(self, db):
+        now = time.monotonic()
+        if self._watermark_at is None or now - self._watermark_at > self.cache_seconds:
+            state = await db.archive_state.find_one({"_id": "orders"})
+            watermark = state["archived_before"] if state else None
+            if watermark != self._watermark:
+                self._keys = None  # new files came with the new watermark
+            self._watermark = watermark
+            self._watermark_at = now
+        return self._watermark
+
+    async def _partition_keys(self):
+        if self._keys is None:
+            self._keys = await asyncio.to_thread(self.store.list, "orders/")
+        return self._keys
+
+    async def read(self, buyer_id: str, start: Optional[datetime], end: Optional[datetime]):
+        keys = [key for key in await self._partition_keys() if month_overlaps(key, start, end)]
+
+        def read_part(key):
+            with self.store.open(key) as source:
+                return decode_orders(source, buyer_id, start, end)
+
+        parts = await asyncio.gather(*(asyncio.to_thread(read_part, key) for key in keys))
+
+        # A job that crashed and was re-run may have written some orders twice
+        orders = {}
+        for part in parts:
+            for order in part:
+                orders[order["id"]] = order
+        return list(orders.values())
+
+    async def archive(self, db, older_than: timedelta, batch_size: int = 5000, grace_seconds: float = 90):
+        cutoff = datetime.utcnow() - older_than
+        state = await db.archive_state.find_one({"_id": "orders"})
+        previous = state["archived_before"] if state else None
+        if previous and previous >= cutoff:
+            logger.info(f"Orders before {previous} are already archived")
+            return 0
+
+        # Copy [previous watermark, cutoff) in (created_at, _id) keyset order
+        query = {"created_at": {"$lt": cutoff}}
+        if previous:
+            query["created_at"]["$gte"] = previous
+        archived = 0
+        last = None
+        pending = {}
+
+        async def flush(month):
+            data = await asyncio.to_thread(encode_tables, pending.pop(month))
+            await asyncio.to_thread(self.store.write, partition_key(*month), data)
+
+        while True:
+            page = dict(query)
+            if last:
+                page["$or"] = [
+                    {"created_at": {"$gt": last["created_at"]}},
+                    {"created_at": last["created_at"], "_id": {"$gt": last["_id"]}},
+                ]
+            batch = await db.orders.find(page).sort([("created_at", 1), ("_id", 1)]).limit(batch_size).to_list(batch_size)
+            if not batch:
+                break
+
+            by_month = {}
+            for order in batch:
+                by_month.setdefault((order["created_at"].year, order["created_at"].month), []).append(order)
+            for month, orders in by_month.items():
+                # Converted right away: columns take far less memory than documents
+                pending.setdefault(month, []).append(await asyncio.to_thread(orders_table, orders))
+
+            # Batches arrive in created_at order, so earlier months are
+            # complete; a month is also cut into a new file once it is big.
+            current = max(by_month)
+            for month in list(pending):
+                if month < current or sum(t.num_rows for t in pending[month]) >= FILE_ROWS:
+                    await flush(month)
+
+            archived += len(batch)
+            last = batch[-1]
+            logger.info(f"Archived {archived} orders (up to {last['created_at']})")
+
+        for month in list(pending):
+            await flush(month)
+
+        # Publish the watermark, then give every API instance time to pick it
+        # up (and stop reading these orders from MongoDB) before deleting them.
+        await db.archive_state.update_one(
+            {"_id": "orders"}, {"$set": {"archived_before": cutoff, "updated_at": datetime.utcnow()}}, upsert=True
+        )
+        self._watermark_at = None
+        if archived:
+            logger.info(f"Waiting {grace_seconds}s before removing archived orders")
+            await asyncio.sleep(grace_seconds)
+            while True:
+                ids = [o["_id"] for o in await db.orders.find(
+                    {"created_at": {"$lt": cutoff}}, {"_id": 1}
+                ).limit(batch_size).to_list(batch_size)]
+                if not ids:
+                    break
+                await db.orders.delete_many({"_id": {"$in": ids}})
+        return archived
+
+
+async def main():
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    root_dir = Path(__file__).parent
+    load_dotenv(root_dir / '.env')
+
+    parser = argparse.ArgumentParser(description="Move old orders into the Parquet archive")
+    parser.add_argument("--older-than-days", type=int, default=int(os.environ.get('ARCHIVE_AFTER_DAYS', '365')))
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--grace-seconds", type=float, default=90)
+    args = parser.parse_args()
+
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    archive = OrderArchive(open_archive_store(os.environ.get('ARCHIVE_URL', str(root_dir / 'archive'))))
+    try:
+        archived = await archive.archive(db, timedelta(days=args.older_than_days), args.batch_size, args.grace_seconds)
+        logger.info(f"Done: {archived} orders archived")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(main())
@@ -0,0 +1,269 @@
+"""Versioned, resumable data migrations.
+
+Each migration is registered with @migration(version, description) and
+applied once, in version order; progress lives in the `schema_migrations`
+collection. Backfills walk a collection in `_id` order in batches, write
+each batch with one unordered bulk_write, checkpoint the last `_id` after
+every batch (so an interrupted run picks up where it stopped) and are
+throttled to a maximum number of documents per second so they can run
+against the live primary.
+
+    python migrations.py status
+    python migrations.py up [--target VERSION] [--batch-size N] [--max-docs-per-second N]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+LOCK_SECONDS = 600
+
+MIGRATIONS = {}
+
+
+def migration(version: int, description: str):
+    def register(fn):
+        if version in MIGRATIONS:
+            raise ValueError(f"Duplicate migration version {version}")
+        MIGRATIONS[version] = (description, fn)
+        return fn
+    return register
+
+
+class MigrationContext:
+    def __init__(self, db, version: int, batch_size: int, max_docs_per_second: float, owner: str):
+        self.db = db
+        self.version = version
+        self.batch_size = batch_size
+        self.max_docs_per_second = max_docs_per_second
+        self.owner = owner
+        self.processed = 0
+        self._started = time.monotonic()
+
+    async def _checkpoint(self, collection: str):
+        state = await self.db.schema_migrations.find_one({"_id": self.version})
+        return (state or {}).get("checkpoints", {}).get(collection)
+
+    async def _save_checkpoint(self, collection: str, last_id, count: int):
+        now = datetime.utcnow()
+        await self.db.schema_migrations.update_one(
+            {"_id": self.version},
+            {"$set": {f"checkpoints.{collection}": last_id, "updated_at": now}, "$inc": {"processed": count}}
+        )
+        # Keep the run lock alive while we make progress
+        await self.db.schema_migrations.update_one(
+            {"_id": "lock", "owner": self.owner},
+            {"$set": {"locked_until": now + timedelta(seconds=LOCK_SECONDS)}}
+        )
+
+    async def _throttle(self):
+        if self.max_docs_per_second <= 0:
+            return
+        ahead = self.processed / self.max_docs_per_second - (time.monotonic() - self._started)
+        if ahead > 0:
+            await asyncio.sleep(ahead)
+
+    async def backfill(self, collection: str, query: dict, transform, projection=None):
+        """Applies transform(doc) -> UpdateOne | None to every document matching query."""
+        coll = self.db[collection]
+        last_id = await self._checkpoint(collection)
+        if last_id is not None:
+            logger.info(f"[{self.version}] Resuming {collection} after _id {last_id}")
+
+        while True:
+            page = query if last_id is None else {"$and": [query, {"_id": {"$gt": last_id}}]}
+            docs = await coll.find(page, projection).sort("_id", 1).limit(self.batch_size).to_list(self.batch_size)
+            if not docs:
+                break
+
+            ops = [op for op in map(transform, docs) if op is not None]
+            if ops:
+                await coll.bulk_write(ops, ordered=False)
+
+            last_id = docs[-1]["_id"]
+            self.processed += len(docs)
+            await self._save_checkpoint(collection, last_id, len(docs))
+            logger.info(f"[{self.version}] {collection}: {self.processed} documents processed")
+            await self._throttle()
+
+
+# ===== Migrations =====
+
+@migration(1, "Backfill products.updated_at from created_at")
+async def add_product_updated_at(ctx: MigrationContext):
+    def transform(doc):
+        return UpdateOne(
+            {"_id": doc["_id"], "updated_at": {"$exists": False}},
+            {"$set": {"updated_at": doc.get("created_at") or doc["_id"].generation_time.replace(tzinfo=None)}}
+        )
+    await ctx.backfill("products", {"updated_at": {"$exists": False}}, transform, {"created_at": 1})
+
+
+@migration(2, "Add an explicit (untracked) stock field to products")
+async def add_product_stock(ctx: MigrationContext):
+    def transform(doc):
+        return UpdateOne({"_id": doc["_id"], "stock": {"$exists": False}}, {"$set": {"stock": None}})
+    await ctx.backfill("products", {"stock": {"$exists": False}}, transform, {"_id": 1})
+
+
+@migration(3, "Store products.farmer_id as ObjectId")
+async def convert_product_farmer_id(ctx: MigrationContext):
+    def transform(doc):
+        if not ObjectId.is_valid(doc["farmer_id"]):
+            logger.warning(f"[{ctx.version}] Product {doc['_id']} has invalid farmer_id {doc['farmer_id']!r}")
+            return None
+        # Match on the old value so a concurrent edit is never overwritten
+        return UpdateOne(
+            {"_id": doc["_id"], "farmer_id": doc["farmer_id"]},
+            {"$set": {"farmer_id": ObjectId(doc["farmer_id"])}}
+        )
+    await ctx.backfill("products", {"farmer_id": {"$type": "string"}}, transform, {"farmer_id": 1})
+
+
+@migration(4, "Backfill carts.updated_at so the cart TTL index can expire them")
+async def add_cart_updated_at(ctx: MigrationContext):
+    now = datetime.utcnow()
+
+    def transform(doc):
+        return UpdateOne({"_id": doc["_id"], "updated_at": {"$exists": False}}, {"$set": {"updated_at": now}})
+    await ctx.backfill("carts", {"updated_at": {"$exists": False}}, transform, {"_id": 1})
+
+
+@migration(5, "Count cart holds in products.reserved and drop the stock_reservations TTL index")
+async def add_product_reserved(ctx: MigrationContext):
+    # Expired holds now stay until the API's sweeper gives their units back;
+    # drop the TTL index first so none disappears after it has been counted
+    for name, spec in (await ctx.db.stock_reservations.index_information()).items():
+        if "expireAfterSeconds" in spec:
+            await ctx.db.stock_reservations.drop_index(name)
+
+    held = {
+        row["_id"]: row["quantity"]
+        async for row in ctx.db.stock_reservations.aggregate(
+            [{"$group": {"_id": "$product_id", "quantity": {"$sum": "$quantity"}}}]
+        )
+    }
+
+    def transform(doc):
+        return UpdateOne(
+            {"_id": doc["_id"], "reserved": {"$exists": False}},
+            {"$set": {"reserved": held.get(str(doc["_id"]), 0)}}
+        )
+    await ctx.backfill("products", {"reserved": {"$exists": False}}, transform, {"_id": 1})
+
+
+@migration(6, "Backfill products.order_count, the popularity typeahead suggestions rank by")
+async def add_product_order_count(ctx: MigrationContext):
+    # Orders already moved to the Parquet archive are not counted
+    ordered = {
+        row["_id"]: row["orders"]
+        async for row in ctx.db.orders.aggregate([
+            {"$unwind": "$items"},
+            {"$group": {"_id": {"order": "$_id", "product": "$items.product_id"}}},
+            {"$group": {"_id": "$_id.product", "orders": {"$sum": 1}}},
+        ])
+    }
+
+    def transform(doc):
+        return UpdateOne(
+            {"_id": doc["_id"], "order_count": {"$exists": False}},
+            {"$set": {"order_count": ordered.get(str(doc["_id"]), 0)}}
+        )
+    await ctx.backfill("products", {"order_count": {"$exists": False}}, transform, {"_id": 1})
+
+
+# ===== Runner =====
+
+async def acquire_lock(db, owner: str):
+    now = datetime.utcnow()
+    await db.schema_migrations.delete_one({"_id": "lock", "locked_until": {"$lt": now}})
+    try:
+        await db.schema_migrations.insert_one(
+            {"_id": "lock", "owner": owner, "locked_until": now + timedelta(seconds=LOCK_SECONDS)}
+        )
+    except DuplicateKeyError:
+        raise RuntimeError("Another migration run holds the lock")
+
+
+async def migration_status(db):
+    states = {doc["_id"]: doc async for doc in db.schema_migrations.find({"_id": {"$type": "number"}})}
+    return [
+        {
+            "version": version,
+            "description": description,
+            "status": states.get(version, {}).get("status", "pending"),
+            "processed": states.get(version, {}).get("processed", 0),
+        }
+        for version, (description, _) in sorted(MIGRATIONS.items())
+    ]
+
+
+async def migrate(db, target: int = None, batch_size: int = 1000, max_docs_per_second: float = 2000):
+    owner = uuid.uuid4().hex
+    await acquire_lock(db, owner)
+    applied = []
+    try:
+        for row in await migration_status(db):
+            version = row["version"]
+            if row["status"] == "applied" or (target is not None and version > target):
+                continue
+
+            description, fn = MIGRATIONS[version]
+            logger.info(f"[{version}] Applying: {description}")
+            await db.schema_migrations.update_one(
+                {"_id": version},
+                {"$set": {"description": description, "status": "running"},
+                 "$setOnInsert": {"started_at": datetime.utcnow(), "processed": 0}},
+                upsert=True
+            )
+            await fn(MigrationContext(db, version, batch_size, max_docs_per_second, owner))
+            await db.schema_migrations.update_one(
+                {"_id": version}, {"$set": {"status": "applied", "applied_at": datetime.utcnow()}}
+            )
+            applied.append(version)
+    finally:
+        await db.schema_migrations.delete_one({"_id": "lock", "owner": owner})
+    return applied
+
+
+async def main():
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / '.env')
+
+    parser = argparse.ArgumentParser(description="Run Lokatani data migrations")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="List migrations and their state")
+    up = commands.add_parser("up", help="Apply pending migrations")
+    up.add_argument("--target", type=int, default=None, help="Stop after this version")
+    up.add_argument("--batch-size", type=int, default=1000)
+    up.add_argument("--max-docs-per-second", type=float, default=2000, help="0 disables throttling")
+    args = parser.parse_args()
+
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        if args.command == "status":
+            for row in await migration_status(db):
+                print(f"{row['version']:>4}  {row['status']:<8} {row['processed']:>10}  {row['description']}")
+        else:
+            applied = await migrate(db, args.target, args.batch_size, args.max_docs_per_second)
+            logger.info(f"Applied migrations: {applied or 'none'}")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(main())
@@ -0,0 +1,118 @@
+"""Product price history stored as bucketed time series.
+
+Every price change is appended to a bucket document in
+`product_price_history`:
+
+    {product_id, start, end, count, t: [datetime, ...], p: [float, ...],
+     min, max}
+
+A bucket holds at most BUCKET_SIZE points in two parallel arrays, so a
+product with thousands of changes is a handful of small documents and a
+range read touches only the buckets overlapping it (index on
+product_id, start, end). Prices are a step function: a point means "the
+price is p from t on", which is how downsample() treats them.
+"""
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+
+BUCKET_SIZE = 200
+
+
+async def ensure_indexes(db):
+    await db.product_price_history.create_index([("product_id", 1), ("start", 1), ("end", 1)])
+
+
+async def record_price(db, product_id: str, price: float, at: datetime, previous: Optional[tuple] = None):
+    """Appends a price point; previous=(price, at) seeds history for products
+    that existed before it was tracked."""
+    if previous and not await db.product_price_history.find_one({"product_id": product_id}, {"_id": 1}):
+        await record_price(db, product_id, *previous)
+
+    # Fills the open bucket or, once it is full, upserts a new one
+    await db.product_price_history.update_one(
+        {"product_id": product_id, "count": {"$lt": BUCKET_SIZE}},
+        {
+            "$push": {"t": at, "p": float(price)},
+            "$inc": {"count": 1},
+            "$min": {"start": at, "min": float(price)},
+            "$max": {"end": at, "max": float(price)},
+        },
+        upsert=True
+    )
+
+
+async def read_points(db, product_id: str, start: Optional[datetime], end: Optional[datetime]):
+    """Returns (times, prices) for [start, end), plus the last point before
+    start so the series begins with the price in effect at start."""
+    query = {"product_id": product_id}
+    if end:
+        query["start"] = {"$lt": end}
+    buckets = await db.product_price_history.find(
+        {**query, "end": {"$gte": start}} if start else query, {"t": 1, "p": 1}
+    ).sort("start", 1).to_list(None)
+    if start:
+        # The newest bucket that ends before start holds the opening price
+        # unless an overlapping bucket already has an earlier point
+        before = await db.product_price_history.find(
+            {"product_id": product_id, "start": {"$lt": start}, "end": {"$lt": start}}, {"t": 1, "p": 1}
+        ).sort("start", -1).limit(1).to_list(1)
+        buckets = before + buckets
+
+    times = [t for b in buckets for t in b["t"]]
+    prices = [p for b in buckets for p in b["p"]]
+    if not times:
+        return np.array([], dtype="datetime64[ms]"), np.array([], dtype=np.float64)
+    times = np.array(times, dtype="datetime64[ms]")
+    prices = np.array(prices, dtype=np.float64)
+    order = np.argsort(times, kind="stable")
+    times, prices = times[order], prices[order]
+
+    lo = 0
+    if start:
+        # Keep the last point at or before start as the opening price
+        lo = max(int(np.searchsorted(times, np.datetime64(start, "ms"), side="right")) - 1, 0)
+    hi = len(times) if not end else int(np.searchsorted(times, np.datetime64(end, "ms"), side="left"))
+    return times[lo:hi], prices[lo:hi]
+
+
+def downsample(times: np.ndarray, prices: np.ndarray, start: datetime, end: datetime, points: int):
+    """Splits [start, end) into at most `points` equal intervals and returns
+    open/high/low/close for each one the series covers; the price carries
+    forward into intervals without changes."""
+    if not len(times) or end <= start:
+        return []
+    t0, t1 = np.datetime64(start, "ms"), np.datetime64(end, "ms")
+    # Integer milliseconds: timedelta64 division truncates instead of flooring
+    span = max(int((t1 - t0) / np.timedelta64(1, "ms")), 1)
+    width_ms = -(-span // points)
+    width = np.timedelta64(width_ms, "ms")
+    n = -(-span // width_ms)
+
+    # An opening point before start counts towards the first interval
+    slot = np.clip((np.maximum(times, t0) - t0) // width, 0, n - 1).astype(np.int64)
+    changed, first = np.unique(slot, return_index=True)
+    last = np.append(first[1:], len(slot)) - 1
+    high = np.maximum.reduceat(prices, first)
+    low = np.minimum.reduceat(prices, first)
+
+    series = []
+    close = None
+    rows = dict(zip(changed.tolist(), zip(first.tolist(), last.tolist(), high.tolist(), low.tolist())))
+    for i in range(int(changed[0]), n):
+        if i in rows:
+            f, l, h, lo = rows[i]
+            # A change part-way through opens at the previous close
+            open_ = close if close is not None and times[f] > t0 + i * width else float(prices[f])
+            close = float(prices[l])
+            series.append({
+                "t": (t0 + i * width).astype(datetime),
+                "open": open_,
+                "high": max(h, open_),
+                "low": min(lo, open_),
+                "close": close,
+            })
+        else:
+            series.append({"t": (t0 + i * width).astype(datetime), "open": close, "high": close, "low": close, "close": close})
+    return series
@@ -0,0 +1,159 @@
+""""Frequently bought together" recommendations from order history.
+
+Co-purchase counts live in `product_copurchase_counts` (one document per
+product, `counts: {other_product_id: n}`) and the top-K neighbours that the
+API serves in the much smaller `product_recommendations` collection.
+
+rebuild() recomputes everything from `orders` with vectorised NumPy
+counting over the basket x product incidence (the sparse BᵀB product);
+record_copurchases() applies one new order incrementally. Rebuild with:
+
+    python recommendations.py [--top-k 10]
+"""
+import argparse
+import asyncio
+import heapq
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import List
+
+import numpy as np
+from pymongo import ReplaceOne, UpdateOne
+
+logger = logging.getLogger(__name__)
+
+TOP_K = int(os.environ.get('RECOMMENDATIONS_TOP_K', '10'))
+
+
+def count_copurchases(baskets: List[np.ndarray], n_products: int):
+    """Returns (rows, cols, counts) of the co-purchase matrix, diagonal excluded.
+
+    Each basket is an array of distinct product indices. Every basket of size
+    k contributes its k*k index pairs, generated without a Python-level loop
+    over items, and identical pairs are summed with np.unique.
+    """
+    if not baskets:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, empty
+
+    lengths = np.array([len(b) for b in baskets], dtype=np.int64)
+    products = np.concatenate(baskets).astype(np.int64)
+    starts = np.cumsum(lengths) - lengths
+    basket_of = np.repeat(np.arange(len(baskets)), lengths)
+
+    # For every item, pair it with every item of its own basket
+    pair_counts = lengths[basket_of]
+    left = np.repeat(products, pair_counts)
+    first = np.repeat(starts[basket_of], pair_counts)
+    offsets = np.arange(pair_counts.sum()) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+    right = products[first + offsets]
+
+    keep = left != right
+    keys, counts = np.unique(left[keep] * n_products + right[keep], return_counts=True)
+    return keys // n_products, keys % n_products, counts
+
+
+def merge_counts(parts, n_products: int):
+    # Sums (rows, cols, counts) triples from several batches
+    rows = np.concatenate([p[0] for p in parts])
+    cols = np.concatenate([p[1] for p in parts])
+    counts = np.concatenate([p[2] for p in parts])
+    keys, inverse = np.unique(rows * n_products + cols, return_inverse=True)
+    return keys // n_products, keys % n_products, np.bincount(inverse, weights=counts).astype(np.int64)
+
+
+def top_neighbours(counts: dict, k: int = TOP_K):
+    best = heapq.nlargest(k, counts.items(), key=lambda pair: (pair[1], pair[0]))
+    return [{"product_id": product_id, "count": int(count)} for product_id, count in best]
+
+
+async def record_copurchases(db, product_ids: List[str], k: int = TOP_K):
+    product_ids = sorted(set(product_ids))
+    if len(product_ids) < 2:
+        return
+
+    await db.product_copurchase_counts.bulk_write([
+        UpdateOne(
+            {"_id": product_id},
+            {"$inc": {f"counts.{other}": 1 for other in product_ids if other != product_id}},
+            upsert=True
+        )
+        for product_id in product_ids
+    ], ordered=False)
+
+    now = datetime.utcnow()
+    ops = []
+    async for doc in db.product_copurchase_counts.find({"_id": {"$in": product_ids}}):
+        ops.append(UpdateOne(
+            {"_id": doc["_id"]},
+            {"$set": {"related": top_neighbours(doc.get("counts", {}), k), "updated_at": now}},
+            upsert=True
+        ))
+    if ops:
+        await db.product_recommendations.bulk_write(ops, ordered=False)
+
+
+async def rebuild(db, k: int = TOP_K, batch_size: int = 10000):
+    # Orders placed while this runs may be missed until the next rebuild
+    index = {}
+    batches = [[]]
+    async for order in db.orders.find({}, {"items.product_id": 1}).batch_size(batch_size):
+        ids = {item.get("product_id") for item in order.get("items", []) if item.get("product_id")}
+        if len(ids) < 2:
+            continue
+        batches[-1].append(np.array([index.setdefault(pid, len(index)) for pid in ids], dtype=np.int64))
+        if len(batches[-1]) >= batch_size:
+            batches.append([])
+
+    n_products = len(index)
+    if not n_products:
+        logger.info("No multi-item orders; nothing to recommend")
+        return 0
+
+    rows, cols, counts = merge_counts([count_copurchases(batch, n_products) for batch in batches], n_products)
+    product_ids = np.array(sorted(index, key=index.get))
+
+    # Rows come out sorted, so each product's neighbours are one contiguous slice
+    boundaries = np.flatnonzero(np.diff(rows)) + 1
+    starts = np.concatenate([[0], boundaries])
+    now = datetime.utcnow()
+    count_ops, recommendation_ops = [], []
+    for start, row_cols, row_counts in zip(starts, np.split(cols, boundaries), np.split(counts, boundaries)):
+        product_id = str(product_ids[rows[start]])
+        neighbours = dict(zip(product_ids[row_cols].tolist(), row_counts.tolist()))
+        count_ops.append(ReplaceOne({"_id": product_id}, {"counts": neighbours}, upsert=True))
+        recommendation_ops.append(ReplaceOne(
+            {"_id": product_id}, {"related": top_neighbours(neighbours, k), "updated_at": now}, upsert=True
+        ))
+
+    for i in range(0, len(count_ops), 1000):
+        await db.product_copurchase_counts.bulk_write(count_ops[i:i + 1000], ordered=False)
+        await db.product_recommendations.bulk_write(recommendation_ops[i:i + 1000], ordered=False)
+    return len(count_ops)
+
+
+async def main():
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / '.env')
+
+    parser = argparse.ArgumentParser(description="Rebuild frequently-bought-together recommendations")
+    parser.add_argument("--top-k", type=int, default=TOP_K)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        products = await rebuild(db, args.top_k, args.batch_size)
+        logger.info(f"Rebuilt recommendations for {products} products")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(main())
@@ -0,0 +1,903 @@
+"""Storage backends behind the API.
+
+Handlers in server.py never touch a database directly; they get a
+UserRepo, ProductRepo, CartRepo and OrderRepo through FastAPI dependencies.
+Two implementations exist:
+
+- MotorRepositories: MongoDB through Motor, the production backend.
+- InMemoryRepositories: plain dicts with secondary indexes (username,
+  farmer, cart lines by product, orders by buyer). Nothing is persisted; it
+  exists so the API can be tested and load-tested at CPU speed without a
+  MongoDB server (STORAGE_BACKEND=memory).
+
+Documents are returned as dicts shaped like the MongoDB ones (`_id` is an
+ObjectId, `id` its string form) so handlers work the same on both.
+"""
+import asyncio
+import bisect
+from abc import ABC, abstractmethod
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+from zoneinfo import ZoneInfo
+
+import numpy as np
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+import price_history
+from recommendations import TOP_K, record_copurchases, top_neighbours
+
+
+def with_id(doc: Optional[dict]):
+    if doc is not None:
+        doc['id'] = str(doc['_id'])
+    return doc
+
+
+def fold_order_facets(facets: dict, orders: List[dict], period_format: str, tz: str = "UTC"):
+    """Adds orders to the raw output of OrderRepo.facets().
+
+    Used for archived orders and by the in-memory backend, so every source
+    goes through the same post-processing in summarize_orders. Periods are
+    cut in `tz`, as $dateToString does with its timezone option.
+    """
+    if not orders:
+        return facets
+
+    zone = ZoneInfo(tz)
+    totals = (facets.get("totals") or [{"_id": None, "order_count": 0, "total_spent": 0}])[0]
+    by_period = {row["_id"]: row for row in facets.get("spend_by_period", [])}
+    item_count = facets["items"][0]["item_count"] if facets.get("items") else 0
+    products = {row["_id"]: row for row in facets.get("top_products", [])}
+
+    for order in orders:
+        created_at = order["created_at"]
+        totals["order_count"] += 1
+        totals["total_spent"] += order["total"]
+        totals["first_order_at"] = min(filter(None, [totals.get("first_order_at"), created_at]))
+        totals["last_order_at"] = max(filter(None, [totals.get("last_order_at"), created_at]))
+
+        key = created_at.replace(tzinfo=timezone.utc).astimezone(zone).strftime(period_format)
+        row = by_period.setdefault(key, {"_id": key, "order_count": 0, "total_spent": 0})
+        row["order_count"] += 1
+        row["total_spent"] += order["total"]
+
+        for item in order["items"]:
+            quantity = item.get("quantity", 0)
+            item_count += quantity
+            row = products.setdefault(item.get("product_id"), {
+                "_id": item.get("product_id"), "quantity": 0, "total_spent": 0,
+            })
+            row.setdefault("product_name", item.get("product_name"))
+            row["quantity"] += quantity
+            row["total_spent"] += (item.get("price") or 0) * quantity
+
+    return {
+        "totals": [totals],
+        "spend_by_period": sorted(by_period.values(), key=lambda row: row["_id"]),
+        "items": [{"_id": None, "item_count": item_count}],
+        "top_products": list(products.values()),
+    }
+
+
+# ===== Interfaces =====
+
+class UserRepo(ABC):
+    @abstractmethod
+    async def get_by_username(self, username: str):
+        ...
+
+    @abstractmethod
+    async def create(self, user: dict) -> str:
+        ...
+
+    @abstractmethod
+    async def revoke_token(self, jti: str, expires_at: datetime) -> bool:
+        """Records the revocation; returns False if the token was already
+        revoked, which is how a refresh token is made single use."""
+
+    @abstractmethod
+    async def revoked_tokens(self, since: Optional[datetime] = None):
+        """Returns [{"jti", "expires_at"}] revoked at or after `since`."""
+
+
+class ProductRepo(ABC):
+    @abstractmethod
+    async def get(self, product_id: str):
+        ...
+
+    @abstractmethod
+    async def get_many(self, product_ids: List[str]):
+        ...
+
+    @abstractmethod
+    async def list(self, limit: int = 1000):
+        ...
+
+    @abstractmethod
+    async def list_by_farmer(self, farmer_id: str, limit: int = 1000):
+        ...
+
+    @abstractmethod
+    async def names_and_locations(self):
+        ...
+
+    @abstractmethod
+    async def existing_ids(self, product_ids: List[str]):
+        ...
+
+    @abstractmethod
+    async def create(self, product: dict) -> str:
+        ...
+
+    @abstractmethod
+    async def update(self, product_id: str, fields: dict):
+        """Applies `fields` and returns the updated product."""
+
+    @abstractmethod
+    async def delete(self, product_id: str):
+        ...
+
+    @abstractmethod
+    async def reserve(self, product_id: str, quantity: int) -> bool:
+        """Atomically adds `quantity` to `reserved` if at least that much
+        stock is neither sold nor reserved."""
+
+    @abstractmethod
+    async def unreserve(self, product_id: str, quantity: int):
+        ...
+
+    @abstractmethod
+    async def take_stock(self, product_id: str, quantity: int, held: int = 0) -> bool:
+        """Atomically decrements stock by `quantity` if stock - reserved + held
+        >= quantity, `held` being the caller's own hold. `reserved` is left
+        alone; the hold gives its units back when it is deleted."""
+
+    @abstractmethod
+    async def return_stock(self, product_id: str, quantity: int):
+        ...
+
+    @abstractmethod
+    async def record_price(self, product_id: str, price: float, at: datetime, previous: Optional[tuple] = None):
+        ...
+
+    @abstractmethod
+    async def price_points(self, product_id: str, start: Optional[datetime], end: Optional[datetime]):
+        """Returns (times, prices) arrays as price_history.read_points does."""
+
+    @abstractmethod
+    async def related_ids(self, product_id: str):
+        ...
+
+    @abstractmethod
+    async def record_copurchases(self, product_ids: List[str]):
+        ...
+
+    @abstractmethod
+    async def record_orders(self, product_ids: List[str]):
+        """Adds one to `order_count` of each product, the popularity that
+        typeahead suggestions are ranked by."""
+
+
+class CartRepo(ABC):
+    @abstractmethod
+    async def get(self, user_id: str):
+        ...
+
+    @abstractmethod
+    async def save_items(self, user_id: str, items: List[dict]):
+        ...
+
+    @abstractmethod
+    async def delete(self, user_id: str):
+        ...
+
+    @abstractmethod
+    async def pull_items(self, user_id: str, product_ids: List[str]):
+        ...
+
+    @abstractmethod
+    async def remove_products(self, product_ids: List[str]) -> int:
+        """Drops the products from every cart and their stock holds; returns
+        the number of carts changed."""
+
+    @abstractmethod
+    async def product_ids(self):
+        ...
+
+    @abstractmethod
+    async def hold(self, user_id: str, product_id: str, quantity: int, expires_at: datetime):
+        """Adds `quantity` to the user's hold and pushes its expiry out."""
+
+    @abstractmethod
+    async def release(self, user_id: str, product_id: Optional[str] = None) -> dict:
+        """Deletes the user's unclaimed holds and returns them by product id.
+        Each hold is deleted atomically, so only one caller ever gets it back."""
+
+    @abstractmethod
+    async def claim(self, user_id: str, token: str, now: datetime) -> dict:
+        """Marks the user's unclaimed holds with `token` for a checkout and
+        returns them by product id. Claimed holds stay counted in
+        products.reserved until release_claimed() deletes them."""
+
+    @abstractmethod
+    async def unclaim(self, token: str):
+        """Gives the holds claimed with `token` back to the user."""
+
+    @abstractmethod
+    async def release_claimed(self, token: str) -> List[dict]:
+        """Deletes and returns the holds claimed with `token`."""
+
+    @abstractmethod
+    async def claim_expired(self, now: datetime, stale_before: datetime) -> List[dict]:
+        """Deletes and returns unclaimed holds that expired at or before `now`
+        and holds claimed at or before `stale_before` by a checkout that
+        never finished."""
+
+
+class OrderRepo(ABC):
+    @abstractmethod
+    async def create(self, order: dict) -> str:
+        ...
+
+    @abstractmethod
+    async def list(self, buyer_id: str, start: Optional[datetime], end: Optional[datetime],
+                   sort_field: str, direction: int, skip: int, limit: int):
+        ...
+
+    @abstractmethod
+    async def facets(self, buyer_id: str, start: Optional[datetime], end: Optional[datetime],
+                     period_format: str, top: Optional[int], tz: str = "UTC"):
+        """Returns raw summary facets (see fold_order_facets); `top` limits
+        the product groups, None returns all of them. Periods are cut in the
+        IANA time zone `tz`."""
+
+    @abstractmethod
+    async def archived_before(self):
+        """Watermark of the Parquet order archive, None if nothing is archived."""
+
+
+# ===== MongoDB =====
+
+def build_order_filter(buyer_id: str, start: Optional[datetime], end: Optional[datetime]):
+    query = {"buyer_id": buyer_id}
+    if start or end:
+        query["created_at"] = {}
+        if start:
+            query["created_at"]["$gte"] = start
+        if end:
+            query["created_at"]["$lt"] = end
+    return query
+
+
+def unreserved_at_least(quantity: int):
+    # False when stock is null (not tracked): null sorts below every number
+    return {"$gte": [{"$subtract": ["$stock", {"$ifNull": ["$reserved", 0]}]}, quantity]}
+
+
+class MotorUserRepo(UserRepo):
+    def __init__(self, db):
+        self.db = db
+
+    async def get_by_username(self, username: str):
+        return with_id(await self.db.users.find_one({"username": username}))
+
+    async def create(self, user: dict):
+        result = await self.db.users.insert_one(user)
+        return str(result.inserted_id)
+
+    async def revoke_token(self, jti: str, expires_at: datetime):
+        # The unique index on jti lets exactly one concurrent caller win
+        try:
+            await self.db.revoked_tokens.insert_one(
+                {"jti": jti, "revoked_at": datetime.utcnow(), "expires_at": expires_at}
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def revoked_tokens(self, since: Optional[datetime] = None):
+        query = {"revoked_at": {"$gte": since}} if since else {}
+        return await self.db.revoked_tokens.find(query, {"_id": 0, "jti": 1, "expires_at": 1}).to_list(None)
+
+
+class MotorProductRepo(ProductRepo):
+    def __init__(self, db):
+        self.db = db
+
+    async def get(self, product_id: str):
+        return with_id(await self.db.products.find_one({"_id": ObjectId(product_id)}))
+
+    async def get_many(self, product_ids: List[str]):
+        products = await self.db.products.find(
+            {"_id": {"$in": [ObjectId(i) for i in product_ids]}}
+        ).to_list(len(product_ids))
+        return [with_id(product) for product in products]
+
+    async def list(self, limit: int = 1000):
+        return [with_id(product) for product in await self.db.products.find().to_list(limit)]
+
+    async def list_by_farmer(self, farmer_id: str, limit: int = 1000):
+        # farmer_id may be a string or an ObjectId until migration 3 has run
+        products = await self.db.products.find({"farmer_id": {"$in": [farmer_id, ObjectId(farmer_id)]}}).to_list(limit)
+        return [with_id(product) for product in products]
+
+    async def names_and_locations(self):
+        return await self.db.products.find({}, {"name": 1, "location": 1, "order_count": 1}).to_list(None)
+
+    async def existing_ids(self, product_ids: List[str]):
+        valid = [ObjectId(pid) for pid in product_ids if ObjectId.is_valid(pid)]
+        return {str(p['_id']) for p in await self.db.products.find({"_id": {"$in": valid}}, {"_id": 1}).to_list(None)}
+
+    async def create(self, product: dict):
+        result = await self.db.products.insert_one(product)
+        return str(result.inserted_id)
+
+    async def update(self, product_id: str, fields: dict):
+        if not fields:
+            return await self.get(product_id)
+        return with_id(await self.db.products.find_one_and_update(
+            {"_id": ObjectId(product_id)}, {"$set": fields}, return_document=ReturnDocument.AFTER
+        ))
+
+    async def delete(self, product_id: str):
+        await self.db.products.delete_one({"_id": ObjectId(product_id)})
+
+    async def reserve(self, product_id: str, quantity: int):
+        result = await self.db.products.update_one(
+            {"_id": ObjectId(product_id), "$expr": unreserved_at_least(quantity)},
+            {"$inc": {"reserved": quantity}}
+        )
+        return result.modified_count > 0
+
+    async def unreserve(self, product_id: str, quantity: int):
+        await self.db.products.update_one({"_id": ObjectId(product_id)}, {"$inc": {"reserved": -quantity}})
+
+    async def take_stock(self, product_id: str, quantity: int, held: int = 0):
+        result = await self.db.products.update_one(
+            {"_id": ObjectId(product_id), "$expr": unreserved_at_least(quantity - held)},
+            {"$inc": {"stock": -quantity}}
+        )
+        return result.modified_count > 0
+
+    async def return_stock(self, product_id: str, quantity: int):
+        await self.db.products.update_one({"_id": ObjectId(product_id)}, {"$inc": {"stock": quantity}})
+
+    async def record_price(self, product_id: str, price: float, at: datetime, previous: Optional[tuple] = None):
+        await price_history.record_price(self.db, product_id, price, at, previous)
+
+    async def price_points(self, product_id: str, start: Optional[datetime], end: Optional[datetime]):
+        return await price_history.read_points(self.db, product_id, start, end)
+
+    async def related_ids(self, product_id: str):
+        # Top-K neighbours are precomputed by recommendations.py
+        doc = await self.db.product_recommendations.find_one({"_id": product_id}, {"related": 1})
+        return [r["product_id"] for r in (doc or {}).get("related", [])]
+
+    async def record_copurchases(self, product_ids: List[str]):
+        await record_copurchases(self.db, product_ids)
+
+    async def record_orders(self, product_ids: List[str]):
+        await self.db.products.update_many(
+            {"_id": {"$in": [ObjectId(pid) for pid in product_ids]}}, {"$inc": {"order_count": 1}}
+        )
+
+
+class MotorCartRepo(CartRepo):
+    def __init__(self, db):
+        self.db = db
+
+    async def get(self, user_id: str):
+        return await self.db.carts.find_one({"user_id": user_id})
+
+    async def save_items(self, user_id: str, items: List[dict]):
+        # Upsert: the TTL monitor may have removed the cart meanwhile
+        await self.db.carts.update_one(
+            {"user_id": user_id},
+            {"$set": {"items": items, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+    async def delete(self, user_id: str):
+        await self.db.carts.delete_one({"user_id": user_id})
+
+    async def pull_items(self, user_id: str, product_ids: List[str]):
+        await self.db.carts.update_one({"user_id": user_id}, {"$pull": {"items": {"product_id": {"$in": product_ids}}}})
+
+    async def remove_products(self, product_ids: List[str]):
+        # Uses the multikey index on items.product_id; updated_at is left alone
+        # so compaction does not keep abandoned carts alive.
+        result = await self.db.carts.update_many(
+            {"items.product_id": {"$in": product_ids}},
+            {"$pull": {"items": {"product_id": {"$in": product_ids}}}}
+        )
+        await self.db.stock_reservations.delete_many({"product_id": {"$in": product_ids}})
+        return result.modified_count
+
+    async def product_ids(self):
+        return await self.db.carts.distinct("items.product_id")
+
+    async def hold(self, user_id: str, product_id: str, quantity: int, expires_at: datetime):
+        await self.db.stock_reservations.update_one(
+            {"user_id": user_id, "product_id": product_id},
+            {"$inc": {"quantity": quantity}, "$max": {"expires_at": expires_at}},
+            upsert=True
+        )
+
+    async def _claim(self, query: dict):
+        # One find_one_and_delete per hold: a hold that the sweeper, a
+        # checkout and a cart edit race for is handed to exactly one of them
+        claimed = []
+        while True:
+            hold = await self.db.stock_reservations.find_one_and_delete(query)
+            if hold is None:
+                return claimed
+            claimed.append(hold)
+
+    async def release(self, user_id: str, product_id: Optional[str] = None):
+        query = {"user_id": user_id, "claim": None}
+        if product_id:
+            query["product_id"] = product_id
+        return {hold['product_id']: hold for hold in await self._claim(query)}
+
+    async def claim(self, user_id: str, token: str, now: datetime):
+        claimed = {}
+        while True:
+            hold = await self.db.stock_reservations.find_one_and_update(
+                {"user_id": user_id, "claim": None},
+                {"$set": {"claim": token, "claimed_at": now}},
+                return_document=ReturnDocument.AFTER
+            )
+            if hold is None:
+                return claimed
+            claimed[hold['product_id']] = hold
+
+    async def unclaim(self, token: str):
+        await self.db.stock_reservations.update_many({"claim": token}, {"$unset": {"claim": "", "claimed_at": ""}})
+
+    async def release_claimed(self, token: str):
+        return await self._claim({"claim": token})
+
+    async def claim_expired(self, now: datetime, stale_before: datetime):
+        return await self._claim({"$or": [
+            {"expires_at": {"$lte": now}, "claim": None},
+            {"claimed_at": {"$lte": stale_before}},
+        ]})
+
+
+class MotorOrderRepo(OrderRepo):
+    def __init__(self, db, archive=None):
+        self.db = db
+        self.archive = archive
+
+    async def create(self, order: dict):
+        result = await self.db.orders.insert_one(order)
+        return str(result.inserted_id)
+
+    async def list(self, buyer_id: str, start: Optional[datetime], end: Optional[datetime],
+                   sort_field: str, direction: int, skip: int, limit: int):
+        cursor = self.db.orders.find(build_order_filter(buyer_id, start, end))
+        cursor = cursor.sort([(sort_field, direction), ("_id", direction)]).skip(skip).limit(limit)
+        return [with_id(order) for order in await cursor.to_list(limit)]
+
+    async def facets(self, buyer_id: str, start: Optional[datetime], end: Optional[datetime],
+                     period_format: str, top: Optional[int], tz: str = "UTC"):
+        # Everything is computed server-side in one round-trip; the leading
+        # $match is served by the (buyer_id, created_at) index.
+        pipeline = [
+            {"$match": build_order_filter(buyer_id, start, end)},
+            {"$facet": {
+                "totals": [
+                    {"$group": {
+                        "_id": None,
+                        "order_count": {"$sum": 1},
+                        "total_spent": {"$sum": "$total"},
+                        "first_order_at": {"$min": "$created_at"},
+                        "last_order_at": {"$max": "$created_at"},
+                    }},
+                ],
+                "spend_by_period": [
+                    {"$group": {
+                        "_id": {"$dateToString": {"format": period_format, "date": "$created_at", "timezone": tz}},
+                        "order_count": {"$sum": 1},
+                        "total_spent": {"$sum": "$total"},
+                    }},
+                    {"$sort": {"_id": 1}},
+                ],
+                "items": [
+                    {"$unwind": "$items"},
+                    {"$group": {"_id": None, "item_count": {"$sum": "$items.quantity"}}},
+                ],
+                "top_products": [
+                    {"$unwind": "$items"},
+                    {"$group": {
+                        "_id": "$items.product_id",
+                        "product_name": {"$last": "$items.product_name"},
+                        "quantity": {"$sum": "$items.quantity"},
+                        "total_spent": {"$sum": {"$multiply": ["$items.price", "$items.quantity"]}},
+                    }},
+                    {"$sort": {"quantity": -1, "_id": 1}},
+                ] + ([] if top is None else [{"$limit": top}]),
+            }},
+        ]
+        result = await self.db.orders.aggregate(pipeline).to_list(1)
+        return result[0] if result else {}
+
+    async def archived_before(self):
+        return await self.archive.archived_before(self.db) if self.archive else None
+
+
+class MotorRepositories:
+    name = "mongo"
+
+    def __init__(self, client, db, archive=None, cart_ttl: timedelta = timedelta(days=30), min_pool_size: int = 5):
+        self.client = client
+        self.db = db
+        self.cart_ttl = cart_ttl
+        self.min_pool_size = min_pool_size
+        self.users = MotorUserRepo(db)
+        self.products = MotorProductRepo(db)
+        self.carts = MotorCartRepo(db)
+        self.orders = MotorOrderRepo(db, archive)
+
+    async def ping(self):
+        await self.client.admin.command('ping')
+
+    async def _ensure_ttl_index(self, collection: str, field: str, seconds: int):
+        try:
+            await self.db[collection].create_index(field, expireAfterSeconds=seconds)
+        except OperationFailure as e:
+            if e.code != 85:  # IndexOptionsConflict: the TTL was changed in config
+                raise
+            await self.db.command("collMod", collection, index={"keyPattern": {field: 1}, "expireAfterSeconds": seconds})
+
+    async def ensure_indexes(self):
+        db = self.db
+        await asyncio.gather(
+            db.users.create_index("username"),
+            db.products.create_index("farmer_id"),
+            db.carts.create_index("user_id"),
+            db.carts.create_index("items.product_id"),
+            self._ensure_ttl_index("carts", "updated_at", int(self.cart_ttl.total_seconds())),
+            price_history.ensure_indexes(db),
+            db.orders.create_index([("buyer_id", 1), ("created_at", -1)]),
+            db.orders.create_index([("created_at", 1), ("_id", 1)]),
+            db.stock_reservations.create_index([("user_id", 1), ("product_id", 1)], unique=True),
+            # No TTL index: expired holds must give their units back to
+            # products.reserved, which the sweeper in server.py does
+            db.stock_reservations.create_index([("expires_at", 1), ("product_id", 1)]),
+            db.stock_reservations.create_index("claimed_at", sparse=True),
+            db.revoked_tokens.create_index("jti", unique=True),
+            db.revoked_tokens.create_index("revoked_at"),
+            db.revoked_tokens.create_index("expires_at", expireAfterSeconds=0),
+        )
+
+    async def warm_up(self):
+        # Concurrent pings force the driver to open minPoolSize sockets now
+        # instead of on the first burst of real traffic.
+        await asyncio.gather(*(self.ping() for _ in range(self.min_pool_size)))
+
+    def close(self):
+        self.client.close()
+
+
+# ===== In-memory =====
+#
+# Every method runs without an await, so on the event loop each one is
+# atomic, which is all the conditional updates (reserve, take_stock, holds)
+# need.
+# Returned documents are copies; callers may mutate them.
+
+def copy_doc(doc: Optional[dict]):
+    if doc is None:
+        return None
+    doc = dict(doc)
+    if isinstance(doc.get('items'), list):
+        doc['items'] = [dict(item) for item in doc['items']]
+    return with_id(doc)
+
+
+class InMemoryUserRepo(UserRepo):
+    def __init__(self):
+        self._users = {}  # ObjectId -> user
+        self._by_username = {}  # username -> ObjectId
+        self._revoked = {}  # jti -> (revoked_at, expires_at)
+
+    async def get_by_username(self, username: str):
+        _id = self._by_username.get(username)
+        return copy_doc(self._users[_id]) if _id else None
+
+    async def create(self, user: dict):
+        user['_id'] = ObjectId()
+        self._users[user['_id']] = dict(user)
+        self._by_username[user['username']] = user['_id']
+        return str(user['_id'])
+
+    async def revoke_token(self, jti: str, expires_at: datetime):
+        if jti in self._revoked:
+            return False
+        self._revoked[jti] = (datetime.utcnow(), expires_at)
+        return True
+
+    async def revoked_tokens(self, since: Optional[datetime] = None):
+        now = datetime.utcnow()
+        self._revoked = {jti: row for jti, row in self._revoked.items() if row[1] > now}
+        return [
+            {"jti": jti, "expires_at": expires_at}
+            for jti, (revoked_at, expires_at) in self._revoked.items()
+            if since is None or revoked_at >= since
+        ]
+
+
+class InMemoryProductRepo(ProductRepo):
+    def __init__(self):
+        self._products = {}  # product id -> product
+        self._by_farmer = {}  # farmer id -> {product id}
+        self._prices = {}  # product id -> ([times], [prices]), sorted by time
+        self._copurchases = {}  # product id -> Counter of other product ids
+
+    def _index(self, product: dict, remove: bool = False):
+        ids = self._by_farmer.setdefault(str(product.get('farmer_id')), set())
+        (ids.discard if remove else ids.add)(str(product['_id']))
+
+    async def get(self, product_id: str):
+        return copy_doc(self._products.get(product_id))
+
+    async def get_many(self, product_ids: List[str]):
+        return [copy_doc(self._products[i]) for i in product_ids if i in self._products]
+
+    async def list(self, limit: int = 1000):
+        return [copy_doc(p) for p, _ in zip(self._products.values(), range(limit))]
+
+    async def list_by_farmer(self, farmer_id: str, limit: int = 1000):
+        ids = sorted(self._by_farmer.get(farmer_id, ()))[:limit]
+        return [copy_doc(self._products[i]) for i in ids]
+
+    async def names_and_locations(self):
+        return [
+            {"name": p.get('name'), "location": p.get('location'), "order_count": p.get('order_count', 0)}
+            for p in self._products.values()
+        ]
+
+    async def existing_ids(self, product_ids: List[str]):
+        return {pid for pid in product_ids if pid in self._products}
+
+    async def create(self, product: dict):
+        product['_id'] = ObjectId()
+        self._products[str(product['_id'])] = dict(product)
+        self._index(product)
+        return str(product['_id'])
+
+    async def update(self, product_id: str, fields: dict):
+        product = self._products.get(product_id)
+        if product is None:
+            return None
+        self._index(product, remove=True)
+        product.update(fields)
+        self._index(product)
+        return copy_doc(product)
+
+    async def delete(self, product_id: str):
+        product = self._products.pop(product_id, None)
+        if product is not None:
+            self._index(product, remove=True)
+
+    def _unreserved(self, product_id: str):
+        product = self._products.get(product_id)
+        if product is None or product.get('stock') is None:
+            return None
+        return product['stock'] - product.get('reserved', 0)
+
+    async def reserve(self, product_id: str, quantity: int):
+        unreserved = self._unreserved(product_id)
+        if unreserved is None or unreserved < quantity:
+            return False
+        product = self._products[product_id]
+        product['reserved'] = product.get('reserved', 0) + quantity
+        return True
+
+    async def unreserve(self, product_id: str, quantity: int):
+        product = self._products.get(product_id)
+        if product is not None:
+            product['reserved'] = product.get('reserved', 0) - quantity
+
+    async def take_stock(self, product_id: str, quantity: int, held: int = 0):
+        unreserved = self._unreserved(product_id)
+        if unreserved is None or unreserved + held < quantity:
+            return False
+        self._products[product_id]['stock'] -= quantity
+        return True
+
+    async def return_stock(self, product_id: str, quantity: int):
+        product = self._products.get(product_id)
+        if product is not None:
+            product['stock'] = (product.get('stock') or 0) + quantity
+
+    async def record_price(self, product_id: str, price: float, at: datetime, previous: Optional[tuple] = None):
+        if previous and product_id not in self._prices:
+            await self.record_price(product_id, *previous)
+        times, prices = self._prices.setdefault(product_id, ([], []))
+        i = bisect.bisect_right(times, at)
+        times.insert(i, at)
+        prices.insert(i, float(price))
+
+    async def price_points(self, product_id: str, start: Optional[datetime], end: Optional[datetime]):
+        times, prices = self._prices.get(product_id, ([], []))
+        # Same window as price_history.read_points: the last point at or
+        # before start opens the series
+        lo = max(bisect.bisect_right(times, start) - 1, 0) if start else 0
+        hi = bisect.bisect_left(times, end) if end else len(times)
+        return np.array(times[lo:hi], dtype="datetime64[ms]"), np.array(prices[lo:hi], dtype=np.float64)
+
+    async def related_ids(self, product_id: str):
+        return [r["product_id"] for r in top_neighbours(self._copurchases.get(product_id, {}), TOP_K)]
+
+    async def record_copurchases(self, product_ids: List[str]):
+        product_ids = set(product_ids)
+        for product_id in product_ids:
+            self._copurchases.setdefault(product_id, Counter()).update(product_ids - {product_id})
+
+    async def record_orders(self, product_ids: List[str]):
+        for product_id in set(product_ids):
+            product = self._products.get(product_id)
+            if product is not None:
+                product['order_count'] = product.get('order_count', 0) + 1
+
+
+class InMemoryCartRepo(CartRepo):
+    def __init__(self, cart_ttl: timedelta = timedelta(days=30)):
+        self.cart_ttl = cart_ttl
+        self._carts = {}  # user id -> cart
+        self._by_product = {}  # product id -> {user id}
+        self._holds = {}  # (user id, product id) -> hold
+        self._holds_by_product = {}  # product id -> {user id}
+
+    def _index(self, cart: dict, remove: bool = False):
+        for item in cart['items']:
+            users = self._by_product.setdefault(item['product_id'], set())
+            (users.discard if remove else users.add)(cart['user_id'])
+
+    def _put(self, user_id: str, items: List[dict], updated_at: datetime):
+        old = self._carts.get(user_id)
+        if old is not None:
+            self._index(old, remove=True)
+        cart = {
+            "_id": old['_id'] if old else ObjectId(),
+            "user_id": user_id,
+            "items": [dict(item) for item in items],
+            "updated_at": updated_at,
+        }
+        self._carts[user_id] = cart
+        self._index(cart)
+
+    async def get(self, user_id: str):
+        cart = self._carts.get(user_id)
+        if cart is not None and cart['updated_at'] < datetime.utcnow() - self.cart_ttl:
+            await self.delete(user_id)  # what the TTL index does in MongoDB
+            return None
+        return copy_doc(cart)
+
+    async def save_items(self, user_id: str, items: List[dict]):
+        self._put(user_id, items, datetime.utcnow())
+
+    async def delete(self, user_id: str):
+        cart = self._carts.pop(user_id, None)
+        if cart is not None:
+            self._index(cart, remove=True)
+
+    async def pull_items(self, user_id: str, product_ids: List[str]):
+        cart = self._carts.get(user_id)
+        if cart is not None:
+            self._put(user_id, [i for i in cart['items'] if i['product_id'] not in product_ids], cart['updated_at'])
+
+    async def remove_products(self, product_ids: List[str]):
+        product_ids = set(product_ids)
+        users = set().union(*(self._by_product.get(pid, ()) for pid in product_ids))
+        for user_id in users:
+            await self.pull_items(user_id, product_ids)
+        for product_id in product_ids:
+            for user_id in self._holds_by_product.pop(product_id, ()):
+                self._holds.pop((user_id, product_id), None)
+        return len(users)
+
+    async def product_ids(self):
+        return [pid for pid, users in self._by_product.items() if users]
+
+    async def hold(self, user_id: str, product_id: str, quantity: int, expires_at: datetime):
+        hold = self._holds.setdefault(
+            (user_id, product_id),
+            {"user_id": user_id, "product_id": product_id, "quantity": 0, "expires_at": expires_at},
+        )
+        hold['quantity'] += quantity
+        hold['expires_at'] = max(hold['expires_at'], expires_at)
+        self._holds_by_product.setdefault(product_id, set()).add(user_id)
+
+    def _pop(self, user_id: str, product_id: str):
+        self._holds_by_product[product_id].discard(user_id)
+        return dict(self._holds.pop((user_id, product_id)))
+
+    def _user_holds(self, user_id: str, product_id: Optional[str] = None):
+        keys = [(user_id, product_id)] if product_id else [key for key in self._holds if key[0] == user_id]
+        return [key for key in keys if key in self._holds and self._holds[key].get('claim') is None]
+
+    async def release(self, user_id: str, product_id: Optional[str] = None):
+        return {key[1]: self._pop(*key) for key in self._user_holds(user_id, product_id)}
+
+    async def claim(self, user_id: str, token: str, now: datetime):
+        claimed = {}
+        for key in self._user_holds(user_id):
+            self._holds[key].update(claim=token, claimed_at=now)
+            claimed[key[1]] = dict(self._holds[key])
+        return claimed
+
+    async def unclaim(self, token: str):
+        for hold in self._holds.values():
+            if hold.get('claim') == token:
+                del hold['claim'], hold['claimed_at']
+
+    async def release_claimed(self, token: str):
+        keys = [key for key, hold in self._holds.items() if hold.get('claim') == token]
+        return [self._pop(*key) for key in keys]
+
+    async def claim_expired(self, now: datetime, stale_before: datetime):
+        def released(hold):
+            if hold.get('claim') is None:
+                return hold['expires_at'] <= now
+            return hold['claimed_at'] <= stale_before
+
+        return [self._pop(*key) for key in [key for key, hold in self._holds.items() if released(hold)]]
+
+
+class InMemoryOrderRepo(OrderRepo):
+    def __init__(self):
+        self._orders = {}  # order id -> order
+        self._by_buyer = {}  # buyer id -> [(created_at, _id)], sorted
+
+    def _range(self, buyer_id: str, start: Optional[datetime], end: Optional[datetime]):
+        keys = self._by_buyer.get(buyer_id, [])
+        lo = bisect.bisect_left(keys, (start,)) if start else 0
+        hi = bisect.bisect_left(keys, (end,)) if end else len(keys)
+        return [self._orders[str(_id)] for _, _id in keys[lo:hi]]
+
+    async def create(self, order: dict):
+        order['_id'] = ObjectId()
+        self._orders[str(order['_id'])] = dict(order)
+        bisect.insort(self._by_buyer.setdefault(order['buyer_id'], []), (order['created_at'], order['_id']))
+        return str(order['_id'])
+
+    async def list(self, buyer_id: str, start: Optional[datetime], end: Optional[datetime],
+                   sort_field: str, direction: int, skip: int, limit: int):
+        orders = sorted(self._range(buyer_id, start, end), key=lambda o: (o[sort_field], o['_id']), reverse=direction < 0)
+        return [copy_doc(order) for order in orders[skip:skip + limit]]
+
+    async def facets(self, buyer_id: str, start: Optional[datetime], end: Optional[datetime],
+                     period_format: str, top: Optional[int], tz: str = "UTC"):
+        # summarize_orders sorts and trims the product groups
+        return fold_order_facets({}, self._range(buyer_id, start, end), period_format, tz)
+
+    async def archived_before(self):
+        return None
+
+
+class InMemoryRepositories:
+    name = "memory"
+
+    def __init__(self, cart_ttl: timedelta = timedelta(days=30)):
+        self.users = InMemoryUserRepo()
+        self.products = InMemoryProductRepo()
+        self.carts = InMemoryCartRepo(cart_ttl)
+        self.orders = InMemoryOrderRepo()
+
+    async def ping(self):
+        return None
+
+    async def ensure_indexes(self):
+        return None
+
+    async def warm_up(self):
+        return None
+
+    def close(self):
+        pass
@@ -1,26 +1,43 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Header, Request
+from fastapi.responses import JSONResponse, FileResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import json
+import hmac
+import time
+import random
+import signal
+import uuid
+from collections import OrderedDict
+import asyncio
 import logging
+from contextlib import asynccontextmanager
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional
-from datetime import datetime, timedelta
+from pydantic import BaseModel, Field, field_validator
+from typing import Any, List, Optional, Union
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from passlib.context import CryptContext
 import bcrypt
 from jose import JWTError, jwt
 from bson import ObjectId
 
+from archive import OrderArchive, open_archive_store
+from repositories import (
+    CartRepo, InMemoryRepositories, MotorRepositories, OrderRepo, ProductRepo, UserRepo, fold_order_facets,
+)
+from suggest import SuggestionIndex
+import price_history
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# "mongo", or "memory" for an in-process store (tests, load tests; nothing is persisted)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mongo')
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '5'))
 
 # Password hashing using bcrypt directly
 def verify_password(plain_password, hashed_password):
@@ -31,15 +48,67 @@ def get_password_hash(password):
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
 
+# Orders older than the archive watermark live in Parquet files here (see archive.py)
+ARCHIVE_URL = os.environ.get('ARCHIVE_URL', str(ROOT_DIR / 'archive'))
+
+# Cart items hold stock for this long; expired holds are given back by a
+# sweeper that runs every HOLD_SWEEP_SECONDS
+RESERVATION_TTL_MINUTES = int(os.environ.get('RESERVATION_TTL_MINUTES', '15'))
+HOLD_SWEEP_SECONDS = float(os.environ.get('HOLD_SWEEP_SECONDS', '30'))
+# Holds claimed by a checkout that has not finished after this long (the
+# process died or the request was cancelled) are given back too
+CHECKOUT_CLAIM_SECONDS = float(os.environ.get('CHECKOUT_CLAIM_SECONDS', '300'))
+
+# Carts untouched for this long are deleted by a TTL index on updated_at
+CART_TTL_DAYS = int(os.environ.get('CART_TTL_DAYS', '30'))
+CART_MAX_LINES = int(os.environ.get('CART_MAX_LINES', '50'))
+CART_COMPACTION_SECONDS = float(os.environ.get('CART_COMPACTION_SECONDS', '3600'))
+
+order_archive = OrderArchive(open_archive_store(ARCHIVE_URL))
+
+if STORAGE_BACKEND == "memory":
+    repos = InMemoryRepositories(cart_ttl=timedelta(days=CART_TTL_DAYS))
+elif STORAGE_BACKEND == "mongo":
+    # MongoDB connection (lazy; the lifespan handler connects and warms it up)
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], minPoolSize=MONGO_MIN_POOL_SIZE)
+    db = client[os.environ['DB_NAME']]
+    repos = MotorRepositories(
+        client, db, order_archive, cart_ttl=timedelta(days=CART_TTL_DAYS), min_pool_size=MONGO_MIN_POOL_SIZE
+    )
+else:
+    raise RuntimeError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}; use 'mongo' or 'memory'")
+
 # JWT settings
-SECRET_KEY = "lokatani_secret_key_2025"
+# Development fallback only: it is in the source, so anyone can sign tokens with it
+DEV_SECRET_KEY = "lokatani_secret_key_2025"
+SECRET_KEY = os.environ.get('SECRET_KEY', DEV_SECRET_KEY)
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30 * 24 * 60  # 30 days
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get('ACCESS_TOKEN_EXPIRE_MINUTES', '15'))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.environ.get('REFRESH_TOKEN_EXPIRE_DAYS', '30'))
+SUGGEST_REBUILD_SECONDS = float(os.environ.get('SUGGEST_REBUILD_SECONDS', '600'))
+RELATED_CACHE_SECONDS = float(os.environ.get('RELATED_CACHE_SECONDS', '300'))
+SINGLEFLIGHT_TIMEOUT = float(os.environ.get('SINGLEFLIGHT_TIMEOUT', '5'))
+REVOCATION_SYNC_SECONDS = float(os.environ.get('REVOCATION_SYNC_SECONDS', '5'))
+
+
+def parse_jwt_keys(value: str):
+    # "kid1:secret1,kid2:secret2" -> {"kid1": "secret1", "kid2": "secret2"}
+    keys = {}
+    for pair in filter(None, (p.strip() for p in value.split(","))):
+        kid, _, secret = pair.partition(":")
+        keys[kid] = secret
+    return keys
+
+
+# Every key verifies; JWT_ACTIVE_KID (default: the first) signs. Tokens
+# without a `kid` header were issued before rotation and use "default".
+JWT_KEYS = parse_jwt_keys(os.environ.get('JWT_KEYS', '')) or {"default": SECRET_KEY}
+JWT_ACTIVE_KID = os.environ.get('JWT_ACTIVE_KID') or next(iter(JWT_KEYS))
 
 # Security
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
-app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
 # Configure logging
@@ -49,6 +118,12 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+if DEV_SECRET_KEY in JWT_KEYS.values():
+    logger.warning(
+        "!!! Tokens are signed with the built-in development key; anyone can forge them. "
+        "Set SECRET_KEY or JWT_KEYS before exposing this server. !!!"
+    )
+
 
 # ===== Models =====
 
@@ -83,7 +158,15 @@ class Product(BaseModel):
     image_base64: str
     farmer_id: str
     farmer_name: str
+    stock: Optional[int] = None  # None means stock is not tracked
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: Optional[datetime] = None
+
+    @field_validator("farmer_id", mode="before")
+    @classmethod
+    def farmer_id_to_str(cls, value):
+        # Stored as ObjectId since migration 3; older documents may still hold strings
+        return str(value) if isinstance(value, ObjectId) else value
 
 
 class ProductCreate(BaseModel):
@@ -92,6 +175,7 @@ class ProductCreate(BaseModel):
     price: float
     location: str
     image_base64: str
+    stock: Optional[int] = Field(None, ge=0)
 
 
 class ProductUpdate(BaseModel):
@@ -100,6 +184,7 @@ class ProductUpdate(BaseModel):
     price: Optional[float] = None
     location: Optional[str] = None
     image_base64: Optional[str] = None
+    stock: Optional[int] = Field(None, ge=0)
 
 
 class CartItem(BaseModel):
@@ -115,7 +200,7 @@ class Cart(BaseModel):
 
 class AddToCart(BaseModel):
     product_id: str
-    quantity: int = 1
+    quantity: int = Field(1, ge=1)
 
 
 class Order(BaseModel):
@@ -133,46 +218,321 @@ class CreateOrder(BaseModel):
     total: float
 
 
+class OrderSummary(BaseModel):
+    order_count: int = 0
+    item_count: int = 0
+    total_spent: float = 0
+    first_order_at: Optional[datetime] = None
+    last_order_at: Optional[datetime] = None
+    period: str
+    spend_by_period: List[dict] = []
+    top_products: List[dict] = []
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+    expires_in: Optional[int] = None
     user: User
 
 
+class BatchRequestItem(BaseModel):
+    id: Optional[str] = None
+    method: str = "GET"
+    path: str  # e.g. "/api/orders?summary=true"
+    body: Optional[Any] = None
+
+
+class BatchRequest(BaseModel):
+    requests: List[BatchRequestItem]
+
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+
+class LogoutRequest(BaseModel):
+    refresh_token: Optional[str] = None
+
+
+# ===== Repositories =====
+#
+# Handlers get their storage through these dependencies, so tests can swap
+# the backend with app.dependency_overrides[get_repositories]. Background
+# jobs use the module-level `repos` directly.
+
+def get_repositories():
+    return repos
+
+
+def get_user_repo(repositories=Depends(get_repositories)) -> UserRepo:
+    return repositories.users
+
+
+def get_product_repo(repositories=Depends(get_repositories)) -> ProductRepo:
+    return repositories.products
+
+
+def get_cart_repo(repositories=Depends(get_repositories)) -> CartRepo:
+    return repositories.carts
+
+
+def get_order_repo(repositories=Depends(get_repositories)) -> OrderRepo:
+    return repositories.orders
+
+
 # ===== Helper Functions =====
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+class SingleFlight:
+    """Coalesces concurrent identical reads into one in-flight call.
+
+    The first caller for a key starts the load; callers arriving while it is
+    still running wait on the same task and get the same result or exception.
+    A load still running after `timeout` seconds is cancelled and everyone
+    waiting on it gets TimeoutError (a 504). Nothing is cached once the load
+    finishes. Results are shared between requests, so loaders return
+    finished documents and callers must not mutate them.
+    """
+
+    instances = []
+
+    def __init__(self, name: str, timeout: float = SINGLEFLIGHT_TIMEOUT):
+        self.name = name
+        self.timeout = timeout
+        self._flights = {}
+        self.calls = 0
+        self.executions = 0
+        self.errors = 0
+        self.timeouts = 0
+        SingleFlight.instances.append(self)
+
+    async def do(self, key, fn):
+        self.calls += 1
+        task = self._flights.get(key)
+        if task is None:
+            self.executions += 1
+            task = asyncio.ensure_future(self._load(fn))
+            self._flights[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        # shield: one caller disconnecting must not cancel the load for
+        # everyone else waiting on it
+        return await asyncio.shield(task)
+
+    async def _load(self, fn):
+        # The timeout is on the load itself, so a hung query is cancelled and
+        # forgotten rather than handed to every later caller for the key
+        return await asyncio.wait_for(fn(), self.timeout)
+
+    def _finish(self, key, task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        if task.cancelled():
+            return
+        if isinstance(task.exception(), asyncio.TimeoutError):
+            self.timeouts += 1
+        elif task.exception() is not None:
+            self.errors += 1
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "executions": self.executions,
+            "coalesced": self.calls - self.executions,
+            "coalescing_ratio": round(1 - self.executions / self.calls, 4) if self.calls else 0.0,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "in_flight": len(self._flights),
+        }
+
+
+class TTLCache:
+    """Small in-process LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, ttl: float, maxsize: int = 10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+
+# Fire-and-forget work spawned by request handlers; references are kept so
+# the tasks are not garbage collected before they finish.
+pending_tasks = set()
+
+
+def spawn(coro, description: str):
+    task = asyncio.create_task(coro)
+    pending_tasks.add(task)
+
+    def done(task):
+        pending_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"{description} failed", exc_info=task.exception())
+
+    task.add_done_callback(done)
+    return task
+
+
+product_reads = SingleFlight("products")
+user_reads = SingleFlight("users")
+
+
+async def load_product(products: ProductRepo, product_id: str):
+    # product_id must already be a valid ObjectId string
+    return await product_reads.do(("product", product_id), lambda: products.get(product_id))
+
+
+async def load_user(users: UserRepo, username: str):
+    return await user_reads.do(("username", username), lambda: users.get_by_username(username))
+
+
+class RevocationList:
+    """In-memory jti deny-list mirrored from the `revoked_tokens` collection.
+
+    Lookups are a dict probe on the 16-byte jti, so checking a token never
+    touches the database. Other instances' revocations arrive through sync(),
+    which only reads documents revoked since the previous pass.
+    """
+
+    def __init__(self, users: UserRepo):
+        self.users = users
+        self._revoked = {}  # jti bytes -> expiry (unix seconds)
+        self._synced_at = None
+
+    def __contains__(self, jti: str):
+        try:
+            return bytes.fromhex(jti) in self._revoked
+        except (TypeError, ValueError):
+            return False
+
+    def __len__(self):
+        return len(self._revoked)
+
+    def add(self, jti: str, exp: int):
+        self._revoked[bytes.fromhex(jti)] = exp
+
+    async def revoke(self, jti: str, exp: int):
+        """Returns False if another request or instance revoked it first."""
+        self.add(jti, exp)
+        return await self.users.revoke_token(jti, datetime.utcfromtimestamp(exp))
+
+    async def sync(self):
+        started = datetime.utcnow()
+        since = None
+        if self._synced_at:
+            # Overlap the window to tolerate clock skew between instances
+            since = self._synced_at - timedelta(seconds=max(30, 2 * REVOCATION_SYNC_SECONDS))
+        for doc in await self.users.revoked_tokens(since):
+            self.add(doc['jti'], int(doc['expires_at'].replace(tzinfo=timezone.utc).timestamp()))
+
+        # Expired tokens fail verification anyway; drop them to keep the set small
+        now = time.time()
+        self._revoked = {jti: exp for jti, exp in self._revoked.items() if exp > now}
+        self._synced_at = started
+
+    async def sync_forever(self):
+        while True:
+            await asyncio.sleep(REVOCATION_SYNC_SECONDS)
+            try:
+                await self.sync()
+            except Exception:
+                logger.exception("Revocation list sync failed")
+
+
+revocations = RevocationList(repos.users)
+
+
+def decode_token(token: str, token_type: str = "access"):
     try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+        kid = jwt.get_unverified_header(token).get("kid", "default")
+        key = JWT_KEYS.get(kid)
+        if key is None:
+            raise JWTError("Unknown signing key")
+        payload = jwt.decode(token, key, algorithms=[ALGORITHM])
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+
+    # Tokens issued before refresh tokens existed carry no `typ` or `jti`
+    if payload.get("sub") is None or payload.get("typ", "access") != token_type:
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    if payload.get("jti") and payload["jti"] in revocations:
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    return payload
+
+
+async def get_current_user(
+    request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    users: UserRepo = Depends(get_user_repo),
+):
+    # Sub-requests of POST /api/batch reuse the user resolved once for the batch
+    batch_user = getattr(request.state, "batch_user", None)
+    if batch_user is not None:
+        return batch_user
+    
+    payload = decode_token(credentials.credentials)
+    username: str = payload["sub"]
     
-    user = await db.users.find_one({"username": username})
+    user = await load_user(users, username)
     if user is None:
         raise HTTPException(status_code=401, detail="User not found")
     
-    user['id'] = str(user['_id'])
     return User(**user)
 
 
-def create_access_token(data: dict):
+def create_token(data: dict, token_type: str, expires_delta: timedelta):
     to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    now = datetime.utcnow()
+    to_encode.update({"typ": token_type, "jti": uuid.uuid4().hex, "iat": now, "exp": now + expires_delta})
+    encoded_jwt = jwt.encode(
+        to_encode, JWT_KEYS[JWT_ACTIVE_KID], algorithm=ALGORITHM, headers={"kid": JWT_ACTIVE_KID}
+    )
     return encoded_jwt
 
 
+def create_access_token(data: dict):
+    return create_token(data, "access", timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+
+
+def create_refresh_token(data: dict):
+    return create_token(data, "refresh", timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS))
+
+
+def issue_tokens(username: str):
+    return {
+        "access_token": create_access_token(data={"sub": username}),
+        "refresh_token": create_refresh_token(data={"sub": username}),
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    }
+
+
 # ===== Auth Endpoints =====
 
 @api_router.post("/register", response_model=Token)
-async def register(user_data: UserRegister):
+async def register(user_data: UserRegister, users: UserRepo = Depends(get_user_repo)):
     # Check if user exists
-    existing_user = await db.users.find_one({"username": user_data.username})
+    existing_user = await users.get_by_username(user_data.username)
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already exists")
     
@@ -190,43 +550,83 @@ async def register(user_data: UserRegister):
         "created_at": datetime.utcnow()
     }
     
-    result = await db.users.insert_one(user_dict)
+    user_id = await users.create(user_dict)
     
-    # Create access token
-    access_token = create_access_token(data={"sub": user_data.username})
-    
-    # Return user and token
-    user_dict['id'] = str(result.inserted_id)
+    # Return user and tokens
+    user_dict['id'] = user_id
     user_dict.pop('password')
     
     return {
-        "access_token": access_token,
-        "token_type": "bearer",
+        **issue_tokens(user_data.username),
         "user": User(**user_dict)
     }
 
 
 @api_router.post("/login", response_model=Token)
-async def login(user_data: UserLogin):
+async def login(user_data: UserLogin, users: UserRepo = Depends(get_user_repo)):
     # Find user
-    user = await db.users.find_one({"username": user_data.username})
+    user = await users.get_by_username(user_data.username)
     if not user or not verify_password(user_data.password, user['password']):
         raise HTTPException(status_code=401, detail="Incorrect username or password")
     
-    # Create access token
-    access_token = create_access_token(data={"sub": user_data.username})
+    # Return user and tokens
+    user.pop('password')
+    
+    return {
+        **issue_tokens(user_data.username),
+        "user": User(**user)
+    }
+
+
+@api_router.post("/token/refresh", response_model=Token)
+async def refresh_token(refresh_data: RefreshRequest, users: UserRepo = Depends(get_user_repo)):
+    payload = decode_token(refresh_data.refresh_token, token_type="refresh")
+    
+    user = await users.get_by_username(payload["sub"])
+    if user is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    
+    # Refresh tokens are single use: rotate on every refresh. The revocation
+    # is an insert, so of two concurrent refreshes with one token only one wins
+    if not await revocations.revoke(payload["jti"], payload["exp"]):
+        raise HTTPException(status_code=401, detail="Token has been reused")
     
-    # Return user and token
-    user['id'] = str(user['_id'])
     user.pop('password')
     
     return {
-        "access_token": access_token,
-        "token_type": "bearer",
+        **issue_tokens(payload["sub"]),
         "user": User(**user)
     }
 
 
+@api_router.post("/logout")
+async def logout(
+    logout_data: Optional[LogoutRequest] = None,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
+):
+    # Either token is enough: a client whose access token has expired must
+    # still be able to revoke its refresh token without rotating it first
+    def valid(token: Optional[str], token_type: str):
+        if not token:
+            return None
+        try:
+            return decode_token(token, token_type)
+        except HTTPException:
+            return None
+
+    payload = valid(credentials and credentials.credentials, "access")
+    refresh_payload = valid(logout_data and logout_data.refresh_token, "refresh")
+    if payload is None and refresh_payload is None:
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    
+    if payload and payload.get("jti"):
+        await revocations.revoke(payload["jti"], payload["exp"])
+    if refresh_payload and (payload is None or refresh_payload["sub"] == payload["sub"]):
+        await revocations.revoke(refresh_payload["jti"], refresh_payload["exp"])
+    
+    return {"message": "Logged out"}
+
+
 @api_router.get("/me", response_model=User)
 async def get_me(current_user: User = Depends(get_current_user)):
     return current_user
@@ -235,54 +635,158 @@ async def get_me(current_user: User = Depends(get_current_user)):
 # ===== Product Endpoints =====
 
 @api_router.get("/products", response_model=List[Product])
-async def get_products():
-    products = await db.products.find().to_list(1000)
-    for product in products:
-        product['id'] = str(product['_id'])
-    return products
+async def get_products(products: ProductRepo = Depends(get_product_repo)):
+    return await product_reads.do(("all",), lambda: products.list(1000))
+
+
+related_cache = TTLCache(RELATED_CACHE_SECONDS)
+
+# Typeahead over product names and locations, ranked by how often their
+# products were ordered. Product writes and orders on this instance update it
+# directly; the periodic rebuild picks up everyone else's.
+product_suggestions = SuggestionIndex()
+
+
+def popularity(product: dict):
+    # Every listing counts once, so products nobody has ordered yet still show
+    return 1 + (product.get('order_count') or 0)
+
+
+def index_product(product: dict, remove: bool = False, weight: Optional[int] = None):
+    apply = product_suggestions.remove if remove else product_suggestions.add
+    weight = popularity(product) if weight is None else weight
+    apply("product", product.get('name', ''), weight)
+    apply("location", product.get('location', ''), weight)
+
+
+async def rebuild_suggestions():
+    entries = []
+    for product in await repos.products.names_and_locations():
+        entries.append(("product", product.get('name', ''), popularity(product)))
+        entries.append(("location", product.get('location', ''), popularity(product)))
+    product_suggestions.load(entries)
+    logger.info(f"Suggestion index rebuilt with {len(product_suggestions)} terms")
+
+
+async def refresh_suggestions_forever():
+    # Runs as a background job, so startup readiness never waits on it
+    while True:
+        try:
+            await rebuild_suggestions()
+        except Exception:
+            logger.exception("Suggestion index rebuild failed")
+        await asyncio.sleep(SUGGEST_REBUILD_SECONDS)
+
+
+@api_router.get("/products/suggest")
+async def suggest_products(
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(10, ge=1, le=25),
+    kind: Optional[str] = Query(None, alias="type", pattern="^(product|location)$"),
+):
+    return product_suggestions.suggest(q, limit, kind)
+
+
+@api_router.get("/products/{product_id}/related", response_model=List[Product])
+async def get_related_products(
+    product_id: str,
+    limit: int = Query(10, ge=1, le=50),
+    products: ProductRepo = Depends(get_product_repo),
+):
+    if not ObjectId.is_valid(product_id):
+        raise HTTPException(status_code=400, detail="Invalid product ID")
+    
+    related = related_cache.get(product_id)
+    if related is None:
+        async def fetch():
+            ids = [i for i in await products.related_ids(product_id) if ObjectId.is_valid(i)]
+            by_id = {product['id']: product for product in await products.get_many(ids)}
+            return [by_id[i] for i in ids if i in by_id]
+        related = await product_reads.do(("related", product_id), fetch)
+        related_cache.set(product_id, related)
+    
+    return related[:limit]
+
+
+@api_router.get("/products/{product_id}/price-history")
+async def get_price_history(
+    product_id: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    points: int = Query(100, ge=1, le=1000),
+    products: ProductRepo = Depends(get_product_repo),
+):
+    if not ObjectId.is_valid(product_id):
+        raise HTTPException(status_code=400, detail="Invalid product ID")
+    start, end = to_naive_utc(start), to_naive_utc(end) or datetime.utcnow()
+    if start and start >= end:
+        raise HTTPException(status_code=400, detail="Start must be before end")
+    
+    product = await load_product(products, product_id)
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    
+    times, prices = await products.price_points(product_id, start, end)
+    if start is None:
+        start = times[0].astype(datetime) if len(times) else end
+    return {
+        "product_id": product_id,
+        "start": start,
+        "end": end,
+        "points": price_history.downsample(times, prices, start, end, points),
+    }
 
 
 @api_router.get("/products/{product_id}", response_model=Product)
-async def get_product(product_id: str):
-    try:
-        product = await db.products.find_one({"_id": ObjectId(product_id)})
-    except:
+async def get_product(product_id: str, products: ProductRepo = Depends(get_product_repo)):
+    if not ObjectId.is_valid(product_id):
         raise HTTPException(status_code=400, detail="Invalid product ID")
     
+    product = await load_product(products, product_id)
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    product['id'] = str(product['_id'])
     return product
 
 
 @api_router.post("/products", response_model=Product)
-async def create_product(product_data: ProductCreate, current_user: User = Depends(get_current_user)):
+async def create_product(
+    product_data: ProductCreate,
+    current_user: User = Depends(get_current_user),
+    products: ProductRepo = Depends(get_product_repo),
+):
     # Only farmers can create products
     if current_user.role != "farmer":
         raise HTTPException(status_code=403, detail="Only farmers can create products")
     
     product_dict = product_data.dict()
-    product_dict['farmer_id'] = current_user.id
+    product_dict['farmer_id'] = ObjectId(current_user.id)
     product_dict['farmer_name'] = current_user.name
     product_dict['created_at'] = datetime.utcnow()
+    product_dict['updated_at'] = product_dict['created_at']
     
-    result = await db.products.insert_one(product_dict)
+    product_id = await products.create(product_dict)
+    index_product(product_dict)
+    await products.record_price(product_id, product_dict['price'], product_dict['created_at'])
     
-    product_dict['id'] = str(result.inserted_id)
+    product_dict['id'] = product_id
     return Product(**product_dict)
 
 
 @api_router.put("/products/{product_id}", response_model=Product)
-async def update_product(product_id: str, product_data: ProductUpdate, current_user: User = Depends(get_current_user)):
+async def update_product(
+    product_id: str,
+    product_data: ProductUpdate,
+    current_user: User = Depends(get_current_user),
+    products: ProductRepo = Depends(get_product_repo),
+):
     # Only farmers can update products
     if current_user.role != "farmer":
         raise HTTPException(status_code=403, detail="Only farmers can update products")
     
-    try:
-        product = await db.products.find_one({"_id": ObjectId(product_id)})
-    except:
+    if not ObjectId.is_valid(product_id):
         raise HTTPException(status_code=400, detail="Invalid product ID")
+    product = await products.get(product_id)
     
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
@@ -294,24 +798,35 @@ async def update_product(product_id: str, product_data: ProductUpdate, current_u
     # Update product
     update_data = {k: v for k, v in product_data.dict().items() if v is not None}
     if update_data:
-        await db.products.update_one({"_id": ObjectId(product_id)}, {"$set": update_data})
+        update_data['updated_at'] = datetime.utcnow()
+    updated_product = await products.update(product_id, update_data)
+    if 'price' in update_data and update_data['price'] != product.get('price'):
+        await products.record_price(
+            product_id, update_data['price'], update_data['updated_at'],
+            previous=(product['price'], product.get('updated_at') or product.get('created_at') or product['_id'].generation_time.replace(tzinfo=None))
+        )
     
-    updated_product = await db.products.find_one({"_id": ObjectId(product_id)})
-    updated_product['id'] = str(updated_product['_id'])
+    if (product.get('name'), product.get('location')) != (updated_product.get('name'), updated_product.get('location')):
+        index_product(product, remove=True)
+        index_product(updated_product)
     
     return Product(**updated_product)
 
 
 @api_router.delete("/products/{product_id}")
-async def delete_product(product_id: str, current_user: User = Depends(get_current_user)):
+async def delete_product(
+    product_id: str,
+    current_user: User = Depends(get_current_user),
+    products: ProductRepo = Depends(get_product_repo),
+    carts: CartRepo = Depends(get_cart_repo),
+):
     # Only farmers can delete products
     if current_user.role != "farmer":
         raise HTTPException(status_code=403, detail="Only farmers can delete products")
     
-    try:
-        product = await db.products.find_one({"_id": ObjectId(product_id)})
-    except:
+    if not ObjectId.is_valid(product_id):
         raise HTTPException(status_code=400, detail="Invalid product ID")
+    product = await products.get(product_id)
     
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
@@ -320,72 +835,206 @@ async def delete_product(product_id: str, current_user: User = Depends(get_curre
     if str(product.get('farmer_id')) != current_user.id:
         raise HTTPException(status_code=403, detail="You can only delete your own products")
     
-    await db.products.delete_one({"_id": ObjectId(product_id)})
+    await products.delete(product_id)
+    index_product(product, remove=True)
+    spawn(carts.remove_products([product_id]), "Removing deleted product from carts")
     
     return {"message": "Product deleted successfully"}
 
 
 @api_router.get("/my-products", response_model=List[Product])
-async def get_my_products(current_user: User = Depends(get_current_user)):
+async def get_my_products(
+    current_user: User = Depends(get_current_user),
+    products: ProductRepo = Depends(get_product_repo),
+):
     if current_user.role != "farmer":
         raise HTTPException(status_code=403, detail="Only farmers have products")
     
-    products = await db.products.find({"farmer_id": current_user.id}).to_list(1000)
-    for product in products:
-        product['id'] = str(product['_id'])
-    return products
+    return await products.list_by_farmer(current_user.id)
+
+
+# ===== Stock =====
+#
+# `products.stock` is the number of units on hand and `products.reserved` the
+# part of it held in carts. Both only change through conditional $inc updates
+# on the product (ProductRepo.reserve / take_stock), so concurrent buyers can
+# never oversell or take units someone else holds. Each hold is also kept per
+# user and product (CartRepo.hold) so checkout can consume the buyer's own
+# hold and the sweeper can give expired ones back.
+
+async def reserve_stock(products: ProductRepo, carts: CartRepo, product: dict, user_id: str, quantity: int):
+    if product.get('stock') is None:
+        return
+
+    product_id = str(product['_id'])
+    if not await products.reserve(product_id, quantity):
+        raise HTTPException(status_code=409, detail="Not enough stock available")
+
+    await carts.hold(user_id, product_id, quantity, datetime.utcnow() + timedelta(minutes=RESERVATION_TTL_MINUTES))
+
+
+async def release_holds(products: ProductRepo, carts: CartRepo, user_id: str, product_id: Optional[str] = None):
+    for held_id, hold in (await carts.release(user_id, product_id)).items():
+        await products.unreserve(held_id, hold['quantity'])
+
+
+async def release_claimed_holds(products: ProductRepo, carts: CartRepo, token: str):
+    for hold in await carts.release_claimed(token):
+        await products.unreserve(hold['product_id'], hold['quantity'])
+
+
+async def release_expired_holds():
+    now = datetime.utcnow()
+    expired = await repos.carts.claim_expired(now, now - timedelta(seconds=CHECKOUT_CLAIM_SECONDS))
+    for hold in expired:
+        await repos.products.unreserve(hold['product_id'], hold['quantity'])
+    return len(expired)
+
+
+async def release_expired_holds_forever():
+    while True:
+        await asyncio.sleep(HOLD_SWEEP_SECONDS)
+        try:
+            released = await release_expired_holds()
+            if released:
+                logger.info(f"Released {released} expired stock holds")
+        except Exception:
+            logger.exception("Releasing expired stock holds failed")
+
+
+def normalize_order_items(items: List[dict]):
+    # Stored as given otherwise, so "2" would reach the order summary as a string
+    normalized = []
+    for item in items:
+        try:
+            fields = {"product_id": str(ObjectId(item['product_id'])), "quantity": int(item['quantity'])}
+            if item.get('price') is not None:
+                fields["price"] = float(item['price'])
+        except Exception:
+            raise HTTPException(status_code=400, detail="Each order item needs a valid product_id and quantity")
+        if fields["quantity"] < 1:
+            raise HTTPException(status_code=400, detail="Quantity must be at least 1")
+        # An explicit null price is dropped rather than stored
+        normalized.append({**{k: v for k, v in item.items() if k != 'price'}, **fields})
+    return normalized
+
+
+def order_quantities(items: List[dict]):
+    quantities = {}
+    for item in items:
+        quantities[item['product_id']] = quantities.get(item['product_id'], 0) + item['quantity']
+    return quantities
+
+
+async def restock(products: ProductRepo, decremented: dict):
+    for product_id, quantity in decremented.items():
+        await products.return_stock(product_id, quantity)
+
+
+async def commit_stock(products: ProductRepo, quantities: dict, holds: dict):
+    # One atomic conditional decrement per product: no read-modify-write, so
+    # hot products see neither lost updates nor lock convoys. The buyer's own
+    # hold counts towards what they may take; other buyers' holds do not. If
+    # any product is short, the decrements already applied are put back.
+    decremented = {}
+    for product_id, quantity in quantities.items():
+        held = holds[product_id]['quantity'] if product_id in holds else 0
+        if await products.take_stock(product_id, quantity, held):
+            decremented[product_id] = quantity
+            continue
+
+        product = await products.get(product_id)
+        if product and product.get('stock') is None:
+            continue  # stock not tracked for this product
+
+        await restock(products, decremented)
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found")
+        raise HTTPException(status_code=409, detail=f"Not enough stock for {product.get('name', product_id)}")
+    return decremented
 
 
 # ===== Cart Endpoints =====
 
+async def compact_carts(batch_size: int = 500):
+    # Catches lines for products deleted by other paths (or before deletes
+    # cleaned up after themselves) so get_cart stops paying for them.
+    product_ids = await repos.carts.product_ids()
+    removed = 0
+    for i in range(0, len(product_ids), batch_size):
+        chunk = product_ids[i:i + batch_size]
+        existing = await repos.products.existing_ids(chunk)
+        missing = [pid for pid in chunk if pid not in existing]
+        if missing:
+            removed += await repos.carts.remove_products(missing)
+    return removed
+
+
+async def compact_carts_forever():
+    while True:
+        await asyncio.sleep(CART_COMPACTION_SECONDS)
+        try:
+            carts = await compact_carts()
+            if carts:
+                logger.info(f"Cart compaction removed stale lines from {carts} carts")
+        except Exception:
+            logger.exception("Cart compaction failed")
+
+
 @api_router.get("/cart")
-async def get_cart(current_user: User = Depends(get_current_user)):
-    cart = await db.carts.find_one({"user_id": current_user.id})
+async def get_cart(
+    current_user: User = Depends(get_current_user),
+    products: ProductRepo = Depends(get_product_repo),
+    carts: CartRepo = Depends(get_cart_repo),
+):
+    cart = await carts.get(current_user.id)
     
     if not cart:
         return {"user_id": current_user.id, "items": []}
     
-    # Get full product details for each item
+    # Get full product details for each item, concurrently
+    items = [item for item in cart.get('items', []) if ObjectId.is_valid(item['product_id'])][:CART_MAX_LINES]
+    loaded = await asyncio.gather(*(load_product(products, item['product_id']) for item in items))
+    
     cart_items = []
-    for item in cart.get('items', []):
-        try:
-            product = await db.products.find_one({"_id": ObjectId(item['product_id'])})
-            if product:
-                product['id'] = str(product['_id'])
-                cart_items.append({
-                    "product": product,
-                    "quantity": item['quantity']
-                })
-        except:
-            continue
+    stale = []
+    for item, product in zip(items, loaded):
+        if product:
+            cart_items.append({
+                "product": Product(**product),
+                "quantity": item['quantity']
+            })
+        else:
+            stale.append(item['product_id'])
+    
+    # Drop lines for deleted products so the next read does not look them up again
+    if stale:
+        spawn(carts.pull_items(current_user.id, stale), "Pruning stale cart lines")
     
     return {"user_id": current_user.id, "items": cart_items}
 
 
 @api_router.post("/cart/add")
-async def add_to_cart(cart_item: AddToCart, current_user: User = Depends(get_current_user)):
+async def add_to_cart(
+    cart_item: AddToCart,
+    current_user: User = Depends(get_current_user),
+    products: ProductRepo = Depends(get_product_repo),
+    carts: CartRepo = Depends(get_cart_repo),
+):
     # Check if product exists
-    try:
-        product = await db.products.find_one({"_id": ObjectId(cart_item.product_id)})
-    except:
+    if not ObjectId.is_valid(cart_item.product_id):
         raise HTTPException(status_code=400, detail="Invalid product ID")
+    product = await products.get(cart_item.product_id)
     
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    # Get or create cart
-    cart = await db.carts.find_one({"user_id": current_user.id})
-    
-    if not cart:
-        cart = {
-            "user_id": current_user.id,
-            "items": [],
-            "updated_at": datetime.utcnow()
-        }
-        await db.carts.insert_one(cart)
+    # Hold stock for the cart before touching it
+    await reserve_stock(products, carts, product, current_user.id, cart_item.quantity)
     
     # Check if product already in cart
-    items = cart.get('items', [])
+    cart = await carts.get(current_user.id)
+    items = cart.get('items', []) if cart else []
     found = False
     
     for item in items:
@@ -395,23 +1044,27 @@ async def add_to_cart(cart_item: AddToCart, current_user: User = Depends(get_cur
             break
     
     if not found:
+        if len(items) >= CART_MAX_LINES:
+            await release_holds(products, carts, current_user.id, cart_item.product_id)
+            raise HTTPException(status_code=400, detail=f"A cart can hold at most {CART_MAX_LINES} products")
         items.append({
             "product_id": cart_item.product_id,
             "quantity": cart_item.quantity
         })
     
-    # Update cart
-    await db.carts.update_one(
-        {"user_id": current_user.id},
-        {"$set": {"items": items, "updated_at": datetime.utcnow()}}
-    )
+    await carts.save_items(current_user.id, items)
     
     return {"message": "Product added to cart"}
 
 
 @api_router.delete("/cart/remove/{product_id}")
-async def remove_from_cart(product_id: str, current_user: User = Depends(get_current_user)):
-    cart = await db.carts.find_one({"user_id": current_user.id})
+async def remove_from_cart(
+    product_id: str,
+    current_user: User = Depends(get_current_user),
+    products: ProductRepo = Depends(get_product_repo),
+    carts: CartRepo = Depends(get_cart_repo),
+):
+    cart = await carts.get(current_user.id)
     
     if not cart:
         raise HTTPException(status_code=404, detail="Cart not found")
@@ -419,59 +1072,310 @@ async def remove_from_cart(product_id: str, current_user: User = Depends(get_cur
     items = cart.get('items', [])
     items = [item for item in items if item['product_id'] != product_id]
     
-    await db.carts.update_one(
-        {"user_id": current_user.id},
-        {"$set": {"items": items, "updated_at": datetime.utcnow()}}
-    )
+    await carts.save_items(current_user.id, items)
+    await release_holds(products, carts, current_user.id, product_id)
     
     return {"message": "Product removed from cart"}
 
 
 @api_router.post("/cart/clear")
-async def clear_cart(current_user: User = Depends(get_current_user)):
-    await db.carts.update_one(
-        {"user_id": current_user.id},
-        {"$set": {"items": [], "updated_at": datetime.utcnow()}}
-    )
+async def clear_cart(
+    current_user: User = Depends(get_current_user),
+    products: ProductRepo = Depends(get_product_repo),
+    carts: CartRepo = Depends(get_cart_repo),
+):
+    # An empty cart is the same as no cart; don't keep the document around
+    await carts.delete(current_user.id)
+    await release_holds(products, carts, current_user.id)
     
     return {"message": "Cart cleared"}
 
 
 # ===== Order Endpoints =====
 
+async def update_recommendations(products: ProductRepo, product_ids: List[str]):
+    await products.record_copurchases(product_ids)
+    for product_id in product_ids:
+        related_cache.invalidate(product_id)
+
+
+async def record_popularity(products: ProductRepo, product_ids: List[str]):
+    await products.record_orders(product_ids)
+    for product in await products.get_many(product_ids):
+        index_product(product, weight=1)
+
+
 @api_router.post("/orders", response_model=Order)
-async def create_order(order_data: CreateOrder, current_user: User = Depends(get_current_user)):
+async def create_order(
+    order_data: CreateOrder,
+    current_user: User = Depends(get_current_user),
+    products: ProductRepo = Depends(get_product_repo),
+    carts: CartRepo = Depends(get_cart_repo),
+    orders: OrderRepo = Depends(get_order_repo),
+):
     # Only buyers can create orders
     if current_user.role != "buyer":
         raise HTTPException(status_code=403, detail="Only buyers can create orders")
     
+    # Take the stock first; a failed check leaves the cart and its holds
+    # untouched. The buyer's holds are claimed, not deleted, so a second
+    # checkout cannot count them again, and they keep their units in
+    # products.reserved until the order exists. A checkout that dies midway
+    # leaves a stale claim for the hold sweeper.
+    items = normalize_order_items(order_data.items)
+    quantities = order_quantities(items)
+    claim = str(ObjectId())
+    holds = await carts.claim(current_user.id, claim, datetime.utcnow())
+    try:
+        decremented = await commit_stock(products, quantities, holds)
+    except Exception:
+        await carts.unclaim(claim)
+        raise
+    
     order_dict = {
         "buyer_id": current_user.id,
         "buyer_name": current_user.name,
-        "items": order_data.items,
+        "items": items,
         "total": order_data.total,
         "status": "completed",  # Mock payment always succeeds
         "created_at": datetime.utcnow()
     }
     
-    result = await db.orders.insert_one(order_dict)
+    try:
+        order_id = await orders.create(order_dict)
+    except Exception:
+        await restock(products, decremented)
+        await carts.unclaim(claim)
+        raise
     
-    # Clear cart after order
-    await db.carts.update_one(
-        {"user_id": current_user.id},
-        {"$set": {"items": [], "updated_at": datetime.utcnow()}}
-    )
+    # Clear cart after order; the stock is taken, so the holds can go
+    await carts.delete(current_user.id)
+    await release_claimed_holds(products, carts, claim)
     
-    order_dict['id'] = str(result.inserted_id)
+    # Popularity and co-purchase counts are not needed to answer the buyer
+    spawn(record_popularity(products, list(quantities)), "Recording product popularity")
+    if len(quantities) > 1:
+        spawn(update_recommendations(products, list(quantities)), "Recording co-purchases")
+    
+    order_dict['id'] = order_id
     return Order(**order_dict)
 
 
-@api_router.get("/orders", response_model=List[Order])
-async def get_orders(current_user: User = Depends(get_current_user)):
-    orders = await db.orders.find({"buyer_id": current_user.id}).to_list(1000)
-    for order in orders:
-        order['id'] = str(order['_id'])
-    return orders
+# Group keys used by the order summary, see get_orders(summary=True)
+ORDER_PERIOD_FORMATS = {
+    "day": "%Y-%m-%d",
+    "week": "%G-W%V",
+    "month": "%Y-%m",
+    "year": "%Y",
+}
+ORDER_SORT_FIELDS = {"created_at", "total"}
+
+
+def to_naive_utc(value: Optional[datetime]):
+    # Stored timestamps are naive UTC; compare query bounds the same way
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def check_timezone(tz: str):
+    try:
+        ZoneInfo(tz)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise HTTPException(status_code=400, detail=f"Unknown time zone: {tz}")
+    return tz
+
+
+async def summarize_orders(
+    orders: OrderRepo,
+    buyer_id: str,
+    start: Optional[datetime],
+    end: Optional[datetime],
+    period: str,
+    top: int,
+    archived: Optional[List[dict]] = None,
+    tz: str = "UTC",
+):
+    # Archived orders, if any, are folded in afterwards, which needs every
+    # product group from the repository.
+    period_format = ORDER_PERIOD_FORMATS[period]
+    facets = await orders.facets(buyer_id, start, end, period_format, None if archived else top, tz)
+    facets = fold_order_facets(facets, archived or [], period_format, tz)
+
+    summary = {"period": period}
+    if facets.get("totals"):
+        totals = facets["totals"][0]
+        totals.pop("_id")
+        summary.update(totals)
+    if facets.get("items"):
+        summary["item_count"] = facets["items"][0]["item_count"]
+    summary["spend_by_period"] = [
+        {"period": row["_id"], "order_count": row["order_count"], "total_spent": row["total_spent"]}
+        for row in facets.get("spend_by_period", [])
+    ]
+    summary["top_products"] = [
+        {
+            "product_id": row["_id"],
+            "product_name": row.get("product_name"),
+            "quantity": row["quantity"],
+            "total_spent": row["total_spent"],
+        }
+        for row in sorted(facets.get("top_products", []), key=lambda row: (-row["quantity"], str(row["_id"])))[:top]
+    ]
+    return OrderSummary(**summary)
+
+
+@api_router.get("/orders", response_model=Union[OrderSummary, List[Order]])
+async def get_orders(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    sort: str = "-created_at",
+    skip: int = Query(0, ge=0),
+    # Clients that don't paginate still get their whole history
+    limit: int = Query(1000, ge=1, le=1000),
+    summary: bool = False,
+    period: str = "month",
+    top: int = Query(5, ge=1, le=50),
+    # Summary periods are cut in the buyer's time zone, e.g. Asia/Jakarta
+    tz: str = "UTC",
+    current_user: User = Depends(get_current_user),
+    orders: OrderRepo = Depends(get_order_repo),
+):
+    start, end = to_naive_utc(start), to_naive_utc(end)
+    if summary and period not in ORDER_PERIOD_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Period must be one of: {', '.join(ORDER_PERIOD_FORMATS)}")
+    check_timezone(tz)
+    sort_field = sort.lstrip("-")
+    if sort_field not in ORDER_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Sort must be one of: {', '.join(sorted(ORDER_SORT_FIELDS))}")
+    direction = -1 if sort.startswith("-") else 1
+
+    # Orders before the watermark are in the archive, later ones in the
+    # repository; a range starting after the watermark skips the archive.
+    archived_before = await orders.archived_before()
+    reaches_archive = archived_before is not None and (start is None or start < archived_before)
+    live_start = start
+    if archived_before is not None:
+        live_start = max(start, archived_before) if start else archived_before
+    if reaches_archive:
+        archive_end = min(end, archived_before) if end else archived_before
+
+    if summary:
+        archived = await order_archive.read(current_user.id, start, archive_end) if reaches_archive else None
+        return await summarize_orders(orders, current_user.id, live_start, end, period, top, archived, tz)
+
+    if not reaches_archive:
+        return await orders.list(current_user.id, start, end, sort_field, direction, skip, limit)
+
+    page = await orders.list(current_user.id, live_start, end, sort_field, direction, 0, skip + limit)
+    # Newest-first pages that MongoDB can fill on its own never touch the archive
+    if not (sort_field == "created_at" and direction == -1 and len(page) >= skip + limit):
+        page += await order_archive.read(current_user.id, start, archive_end)
+        page.sort(key=lambda order: (order[sort_field], order['id']), reverse=direction < 0)
+    return page[skip:skip + limit]
+
+
+# ===== Batch Endpoint =====
+
+BATCH_MAX_REQUESTS = int(os.environ.get('BATCH_MAX_REQUESTS', '20'))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '4'))
+BATCH_METHODS = {"GET", "POST", "PUT", "DELETE"}
+
+
+async def dispatch_subrequest(request: Request, item: BatchRequestItem, user: Optional[User]):
+    path, _, query_string = item.path.partition("?")
+    body = json.dumps(item.body).encode("utf-8") if item.body is not None else b""
+
+    headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    authorization = request.headers.get("authorization")
+    if authorization:
+        headers.append((b"authorization", authorization.encode("latin-1")))
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": item.method.upper(),
+        "scheme": request.url.scheme,
+        "path": path,
+        "raw_path": path.encode("utf-8"),
+        "root_path": "",
+        "query_string": query_string.encode("utf-8"),
+        "headers": headers,
+        "client": request.scope.get("client"),
+        "server": request.scope.get("server"),
+        "state": {"batch_user": user},
+    }
+
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if request_sent:
+            return {"type": "http.disconnect"}
+        request_sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    status = 500
+    content_type = ""
+    chunks = []
+
+    async def send(message):
+        nonlocal status, content_type
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            for name, value in message.get("headers", []):
+                if name.lower() == b"content-type":
+                    content_type = value.decode("latin-1")
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    try:
+        await request.app(scope, receive, send)
+    except Exception:
+        # ServerErrorMiddleware has already produced the 500 response; it
+        # re-raises so the error still gets logged.
+        logger.exception(f"Batch sub-request {item.method} {item.path} failed")
+
+    raw = b"".join(chunks)
+    if content_type.startswith("application/json") and raw:
+        payload = json.loads(raw)
+    else:
+        payload = raw.decode("utf-8", errors="replace")
+    return {"id": item.id, "status": status, "body": payload}
+
+
+@api_router.post("/batch")
+async def batch(batch_data: BatchRequest, request: Request, users: UserRepo = Depends(get_user_repo)):
+    if len(batch_data.requests) > BATCH_MAX_REQUESTS:
+        raise HTTPException(status_code=400, detail=f"A batch can hold at most {BATCH_MAX_REQUESTS} requests")
+    
+    for item in batch_data.requests:
+        if item.method.upper() not in BATCH_METHODS:
+            raise HTTPException(status_code=400, detail=f"Unsupported method: {item.method}")
+        if not item.path.startswith("/api/") or item.path.partition("?")[0].rstrip("/") == "/api/batch":
+            raise HTTPException(status_code=400, detail=f"Invalid batch path: {item.path}")
+    
+    # Resolve the caller once; sub-requests that need auth reuse it. An
+    # invalid token is not fatal here: those sub-requests get their own 401.
+    user = None
+    authorization = request.headers.get("authorization", "")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() == "bearer" and token:
+        try:
+            credentials = HTTPAuthorizationCredentials(scheme=scheme, credentials=token)
+            user = await get_current_user(request, credentials, users)
+        except HTTPException:
+            user = None
+    
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def run(item):
+        async with semaphore:
+            return await dispatch_subrequest(request, item, user)
+    
+    responses = await asyncio.gather(*(run(item) for item in batch_data.requests))
+    return {"responses": responses}
 
 
 # ===== Root Route =====
@@ -481,6 +1385,354 @@ async def root():
     return {"message": "Lokatani API - Marketplace untuk Petani & Pembeli"}
 
 
+# ===== Lifecycle =====
+
+MONGO_STARTUP_TIMEOUT = float(os.environ.get('MONGO_STARTUP_TIMEOUT', '30'))
+PROBE_TIMEOUT = float(os.environ.get('PROBE_TIMEOUT', '2'))
+DRAIN_TIMEOUT = float(os.environ.get('DRAIN_TIMEOUT', '25'))
+# How long shutdown waits for spawn()ed tasks before closing storage
+PENDING_TASKS_TIMEOUT = float(os.environ.get('PENDING_TASKS_TIMEOUT', '10'))
+# Seconds between SIGTERM and shutdown. Requests are still served but /readyz
+# fails, so the load balancer stops routing here before connections close.
+DRAIN_DELAY = float(os.environ.get('DRAIN_DELAY', '5'))
+PROBE_PATHS = {"/healthz", "/readyz"}
+
+# Coroutine functions run once at startup, after indexes exist and before
+# /readyz reports ready. A failing hook is logged but does not block startup.
+warmup_hooks = [revocations.sync]
+
+# Long-running coroutine functions started once the app is ready and
+# cancelled on shutdown.
+background_jobs = [
+    revocations.sync_forever, refresh_suggestions_forever, compact_carts_forever, release_expired_holds_forever,
+]
+
+
+class Lifecycle:
+    def __init__(self):
+        self.state = "starting"  # starting -> ready -> draining -> stopping -> stopped
+        self.started_at = None
+        self.in_flight = 0
+        self.drain_timer = None  # pending SIGINT after a SIGTERM
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    def request_started(self):
+        self.in_flight += 1
+        self._idle.clear()
+
+    def request_finished(self):
+        self.in_flight -= 1
+        if self.in_flight == 0:
+            self._idle.set()
+
+    async def drain(self, timeout: float):
+        self.state = "stopping"
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            logger.warning(f"Drain timed out with {self.in_flight} request(s) still in flight")
+            return False
+
+
+lifecycle = Lifecycle()
+
+
+def start_shutdown():
+    lifecycle.drain_timer = None
+    signal.raise_signal(signal.SIGINT)
+
+
+def handle_sigterm():
+    # Uvicorn exits on SIGTERM straight away; fail readiness first and hand
+    # over to its graceful SIGINT shutdown once DRAIN_DELAY has passed.
+    # A second SIGTERM skips the wait. Only one SIGINT is ever raised: a
+    # second one makes uvicorn force-exit without draining connections.
+    if lifecycle.state == "draining" and lifecycle.drain_timer is not None:
+        lifecycle.drain_timer.cancel()
+        start_shutdown()
+        return
+    if lifecycle.state != "ready":
+        return  # shutdown is already under way
+    lifecycle.state = "draining"
+    logger.info(f"SIGTERM received, shutting down in {DRAIN_DELAY}s")
+    lifecycle.drain_timer = asyncio.get_running_loop().call_later(DRAIN_DELAY, start_shutdown)
+
+
+async def ping_storage():
+    started = time.perf_counter()
+    await asyncio.wait_for(repos.ping(), PROBE_TIMEOUT)
+    return round((time.perf_counter() - started) * 1000, 2)
+
+
+async def wait_for_storage():
+    deadline = time.monotonic() + MONGO_STARTUP_TIMEOUT
+    delay = 0.25
+    while True:
+        try:
+            return await ping_storage()
+        except Exception as e:
+            if time.monotonic() + delay > deadline:
+                raise
+            logger.warning(f"Storage ({repos.name}) not reachable yet ({e}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    latency = await wait_for_storage()
+    logger.info(f"Connected to {repos.name} storage ({latency} ms)")
+    await repos.ensure_indexes()
+    await repos.warm_up()
+    for hook in warmup_hooks:
+        try:
+            await hook()
+        except Exception:
+            logger.exception(f"Warm-up hook {hook.__name__} failed")
+
+    jobs = [asyncio.create_task(job()) for job in background_jobs]
+    try:
+        # Replaces uvicorn's handler, which is installed before startup
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, handle_sigterm)
+    except (NotImplementedError, RuntimeError, ValueError):
+        logger.info("SIGTERM drain delay unavailable (not on the main thread or unsupported platform)")
+    lifecycle.state = "ready"
+    lifecycle.started_at = time.monotonic()
+    logger.info("Application ready")
+
+    yield
+
+    # Uvicorn has already stopped accepting connections at this point; wait
+    # for anything still running before pulling the database out from under it.
+    await lifecycle.drain(DRAIN_TIMEOUT)
+    for job in jobs:
+        job.cancel()
+    await asyncio.gather(*jobs, return_exceptions=True)
+    # Requests are done, but work they spawned (co-purchase counts, cart
+    # pruning) may still be writing
+    if pending_tasks:
+        _, unfinished = await asyncio.wait(set(pending_tasks), timeout=PENDING_TASKS_TIMEOUT)
+        if unfinished:
+            logger.warning(f"Cancelling {len(unfinished)} background task(s) still running at shutdown")
+            for task in unfinished:
+                task.cancel()
+    repos.close()
+    lifecycle.state = "stopped"
+
+
+class InFlightMiddleware:
+    """Tracks in-flight requests, asks clients to reconnect elsewhere while
+    draining and turns new requests away once shutdown has started."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in PROBE_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        if lifecycle.state in ("stopping", "stopped"):
+            response = JSONResponse(
+                {"detail": "Server is shutting down"},
+                status_code=503,
+                headers={"Retry-After": "1", "Connection": "close"},
+            )
+            await response(scope, receive, send)
+            return
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and lifecycle.state == "draining":
+                message["headers"] = list(message.get("headers", [])) + [(b"connection", b"close")]
+            await send(message)
+
+        lifecycle.request_started()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            lifecycle.request_finished()
+
+
+# ===== Profiling =====
+#
+# Opt-in request profiling. A request is profiled when it carries
+# `X-Profile: 1` plus `X-Admin-Secret: <PROFILING_SECRET>`, or when it is
+# picked by PROFILE_SAMPLE_RATE; sampled profiles are only kept when the
+# handler took at least PROFILE_SLOW_MS. Profiles are written to PROFILE_DIR
+# as speedscope JSON (https://www.speedscope.app) or pyinstrument HTML.
+# With no secret and a zero sample rate the middleware is not installed.
+
+PROFILING_SECRET = os.environ.get('PROFILING_SECRET', '')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', '500'))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', '0.001'))
+PROFILE_FORMAT = os.environ.get('PROFILE_FORMAT', 'speedscope')  # "speedscope" or "html"
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '100'))
+PROFILE_DIR = Path(os.environ.get('PROFILE_DIR', ROOT_DIR / 'profiles'))
+PROFILING_ENABLED = bool(PROFILING_SECRET) or PROFILE_SAMPLE_RATE > 0
+
+
+def is_admin_secret(value: Optional[str]):
+    # compare_digest rejects non-ASCII str; header values are latin-1 decoded
+    # bytes, so compare those against the secret as a client would send it
+    if not PROFILING_SECRET or not value:
+        return False
+    return hmac.compare_digest(value.encode("latin-1"), PROFILING_SECRET.encode("utf-8"))
+
+
+PROFILE_SUFFIX = ".html" if PROFILE_FORMAT == "html" else ".speedscope.json"
+
+
+def write_profile(session, filename: str):
+    if PROFILE_FORMAT == "html":
+        from pyinstrument.renderers import HTMLRenderer
+        output = HTMLRenderer().render(session)
+    else:
+        from pyinstrument.renderers import SpeedscopeRenderer
+        output = SpeedscopeRenderer().render(session)
+
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    path = PROFILE_DIR / filename
+    path.write_text(output, encoding="utf-8")
+
+    # Keep only the newest PROFILE_KEEP files
+    profiles = sorted(PROFILE_DIR.iterdir(), key=lambda p: p.stat().st_mtime, reverse=True)
+    for old in profiles[PROFILE_KEEP:]:
+        old.unlink(missing_ok=True)
+    return path
+
+
+class ProfilingMiddleware:
+    """Profiles selected requests with pyinstrument's async-aware wall-clock sampler."""
+
+    def __init__(self, app):
+        self.app = app
+        # One profile at a time keeps the overhead bounded under load
+        self.busy = False
+
+    def wants_profile(self, scope):
+        headers = dict(scope["headers"])
+        if headers.get(b"x-profile") == b"1":
+            secret = headers.get(b"x-admin-secret", b"").decode("latin-1")
+            return "requested" if is_admin_secret(secret) else None
+        if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            return "sampled"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.busy:
+            await self.app(scope, receive, send)
+            return
+
+        reason = self.wants_profile(scope)
+        if reason is None:
+            await self.app(scope, receive, send)
+            return
+
+        from pyinstrument import Profiler
+
+        slug = scope["path"].strip("/").replace("/", "_") or "root"
+        name = f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-{scope['method']}-{slug}{PROFILE_SUFFIX}"
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start" and reason == "requested":
+                message.setdefault("headers", []).append((b"x-profile-id", name.encode("latin-1")))
+            await send(message)
+
+        self.busy = True
+        profiler = Profiler(interval=PROFILE_INTERVAL, async_mode="enabled")
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            session = profiler.stop()
+            self.busy = False
+            if reason == "requested" or session.duration * 1000 >= PROFILE_SLOW_MS:
+                try:
+                    path = await asyncio.to_thread(write_profile, session, name)
+                    logger.info(f"Saved {reason} profile of {scope['method']} {scope['path']} "
+                                f"({session.duration * 1000:.1f} ms) to {path.name}")
+                except Exception:
+                    logger.exception("Could not save request profile")
+
+
+def require_admin_secret(x_admin_secret: Optional[str] = Header(None)):
+    if not is_admin_secret(x_admin_secret):
+        raise HTTPException(status_code=403, detail="Admin secret required")
+
+
+@api_router.get("/admin/metrics", dependencies=[Depends(require_admin_secret)])
+async def get_metrics():
+    return {
+        "singleflight": {flight.name: flight.stats() for flight in SingleFlight.instances},
+        "revoked_tokens": len(revocations),
+        "in_flight_requests": lifecycle.in_flight,
+    }
+
+
+@api_router.get("/admin/profiles", dependencies=[Depends(require_admin_secret)])
+async def list_profiles():
+    if not PROFILE_DIR.is_dir():
+        return []
+    profiles = sorted(PROFILE_DIR.iterdir(), key=lambda p: p.stat().st_mtime, reverse=True)
+    return [
+        {"name": p.name, "size": p.stat().st_size, "created_at": datetime.utcfromtimestamp(p.stat().st_mtime)}
+        for p in profiles
+    ]
+
+
+@api_router.get("/admin/profiles/{name}", dependencies=[Depends(require_admin_secret)])
+async def download_profile(name: str):
+    path = PROFILE_DIR / name
+    if Path(name).name != name or not path.is_file():
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, filename=name)
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.exception_handler(asyncio.TimeoutError)
+async def timeout_exception_handler(request: Request, exc: asyncio.TimeoutError):
+    return JSONResponse({"detail": "Upstream query timed out"}, status_code=504)
+
+
+async def dependency_status():
+    try:
+        return True, {repos.name: {"ok": True, "latency_ms": await ping_storage()}}
+    except Exception as e:
+        return False, {repos.name: {"ok": False, "error": str(e) or type(e).__name__}}
+
+
+@app.get("/healthz")
+async def healthz():
+    # Liveness: the process is up. Dependencies are checked by /readyz only,
+    # so a slow database can't get the pod restarted.
+    uptime = time.monotonic() - lifecycle.started_at if lifecycle.started_at else 0
+    return {
+        "status": "ok",
+        "state": lifecycle.state,
+        "uptime_s": round(uptime, 1),
+        "in_flight": lifecycle.in_flight,
+    }
+
+
+@app.get("/readyz")
+async def readyz():
+    healthy, dependencies = await dependency_status()
+    ready = lifecycle.ready and healthy
+    return JSONResponse(
+        {"status": "ready" if ready else "not_ready", "state": lifecycle.state, "dependencies": dependencies},
+        status_code=200 if ready else 503,
+    )
+
+
 # Include router in app
 app.include_router(api_router)
 
@@ -492,7 +1744,7 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(InFlightMiddleware)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
+if PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware)
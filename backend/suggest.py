@@ -0,0 +1,119 @@
+"""In-memory prefix index for typeahead suggestions.
+
+Terms (product names, locations) are normalised (lower case, accents and
+extra whitespace removed) and every word suffix of a term is kept in one
+sorted list, so "merah" finds "Cabai Merah" as well as "Merah Delima".
+A lookup is a bisect to the first key with the query as prefix followed by a
+forward scan over every key with that prefix; matches are ranked by weight,
+a popularity score the caller supplies (server.py uses order counts).
+One- and two-letter prefixes match most of the index, so their ranked top
+TOP_K is cached per kind and dropped only when a term under that prefix
+changes.
+"""
+import bisect
+import heapq
+import unicodedata
+
+# Prefixes up to this length have their ranking cached
+SHORT_PREFIX = 2
+# Largest `limit` answered from the cache; larger ones scan
+TOP_K = 25
+
+
+def normalize(text: str):
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.lower().split())
+
+
+def word_suffixes(norm: str):
+    words = norm.split(" ")
+    return {" ".join(words[i:]) for i in range(len(words))}
+
+
+class SuggestionIndex:
+    def __init__(self):
+        self._keys = []  # sorted (key, term)
+        self._weights = {}  # term -> weight, term = (kind, normalised text)
+        self._labels = {}  # term -> display text
+        self._top = {}  # (short prefix, kind or None) -> ranked terms
+
+    def _invalidate(self, term):
+        for key in word_suffixes(term[1]):
+            for n in range(1, SHORT_PREFIX + 1):
+                for kind in (None, term[0]):
+                    self._top.pop((key[:n], kind), None)
+
+    def __len__(self):
+        return len(self._weights)
+
+    def add(self, kind: str, text: str, weight: int = 1):
+        norm = normalize(text)
+        if not norm:
+            return
+        term = (kind, norm)
+        if term not in self._weights:
+            self._weights[term] = 0
+            self._labels[term] = " ".join(text.split())
+            for key in word_suffixes(norm):
+                bisect.insort(self._keys, (key, term))
+        self._weights[term] += weight
+        self._invalidate(term)
+
+    def remove(self, kind: str, text: str, weight: int = 1):
+        term = (kind, normalize(text))
+        if term not in self._weights:
+            return
+        self._weights[term] -= weight
+        self._invalidate(term)
+        if self._weights[term] > 0:
+            return
+        del self._weights[term]
+        del self._labels[term]
+        for key in word_suffixes(term[1]):
+            i = bisect.bisect_left(self._keys, (key, term))
+            if i < len(self._keys) and self._keys[i] == (key, term):
+                del self._keys[i]
+
+    def load(self, entries):
+        """Replaces the whole index with (kind, text, weight) entries in one
+        sort. Entries for the same term add up."""
+        weights, labels = {}, {}
+        for kind, text, weight in entries:
+            norm = normalize(text)
+            if not norm:
+                continue
+            term = (kind, norm)
+            weights[term] = weights.get(term, 0) + weight
+            labels.setdefault(term, " ".join(text.split()))
+        keys = sorted((key, term) for term in weights for key in word_suffixes(term[1]))
+
+        # Swap everything at once; there is no await in here, so readers on
+        # the event loop never see a half-built index.
+        self._keys, self._weights, self._labels, self._top = keys, weights, labels, {}
+
+    def _rank(self, prefix: str, limit: int, kind: str = None):
+        matches = set()
+        i = bisect.bisect_left(self._keys, (prefix,))
+        while i < len(self._keys):
+            key, term = self._keys[i]
+            if not key.startswith(prefix):
+                break
+            if kind is None or term[0] == kind:
+                matches.add(term)
+            i += 1
+        return heapq.nlargest(limit, matches, key=lambda term: (self._weights[term], -len(term[1]), term))
+
+    def suggest(self, query: str, limit: int = 10, kind: str = None):
+        prefix = normalize(query)
+        if not prefix:
+            return []
+
+        if len(prefix) <= SHORT_PREFIX and limit <= TOP_K:
+            ranked = self._top.get((prefix, kind))
+            if ranked is None:
+                ranked = self._top[(prefix, kind)] = self._rank(prefix, TOP_K, kind)
+            ranked = ranked[:limit]
+        else:
+            ranked = self._rank(prefix, limit, kind)
+        return [{"text": self._labels[term], "type": term[0], "weight": self._weights[term]} for term in ranked]
@@ -15,6 +15,7 @@ interface AuthContextType {
 const AuthContext = createContext<AuthContextType | undefined>(undefined);
 
 const TOKEN_STORAGE_KEY = 'auth_token';
+const REFRESH_TOKEN_STORAGE_KEY = 'auth_refresh_token';
 const USER_STORAGE_KEY = 'auth_user';
 
 export const AuthProvider = ({ children }: { children: ReactNode }) => {
@@ -24,17 +25,23 @@ export const AuthProvider = ({ children }: { children: ReactNode }) => {
 
   useEffect(() => {
     loadStoredAuth();
+    api.onTokensRefreshed((authData) => {
+      saveAuth(authData);
+    });
+    return () => api.onTokensRefreshed(null);
   }, []);
 
   const loadStoredAuth = async () => {
     try {
       const storedToken = await AsyncStorage.getItem(TOKEN_STORAGE_KEY);
+      const storedRefreshToken = await AsyncStorage.getItem(REFRESH_TOKEN_STORAGE_KEY);
       const storedUser = await AsyncStorage.getItem(USER_STORAGE_KEY);
 
       if (storedToken && storedUser) {
         setToken(storedToken);
         setUser(JSON.parse(storedUser));
         api.setAuthToken(storedToken);
+        api.setRefreshToken(storedRefreshToken);
       }
     } catch (error) {
       console.error('Error loading auth:', error);
@@ -65,17 +72,29 @@ export const AuthProvider = ({ children }: { children: ReactNode }) => {
     setToken(authData.access_token);
     setUser(authData.user);
     api.setAuthToken(authData.access_token);
+    api.setRefreshToken(authData.refresh_token);
     
     await AsyncStorage.setItem(TOKEN_STORAGE_KEY, authData.access_token);
+    if (authData.refresh_token) {
+      await AsyncStorage.setItem(REFRESH_TOKEN_STORAGE_KEY, authData.refresh_token);
+    }
     await AsyncStorage.setItem(USER_STORAGE_KEY, JSON.stringify(authData.user));
   };
 
   const logout = async () => {
+    try {
+      await api.logout();
+    } catch (error) {
+      console.error('Error revoking tokens:', error);
+    }
+
     setToken(null);
     setUser(null);
     api.setAuthToken(null);
+    api.setRefreshToken(null);
     
     await AsyncStorage.removeItem(TOKEN_STORAGE_KEY);
+    await AsyncStorage.removeItem(REFRESH_TOKEN_STORAGE_KEY);
     await AsyncStorage.removeItem(USER_STORAGE_KEY);
   };
 
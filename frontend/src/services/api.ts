@@ -11,6 +11,40 @@ const axiosInstance = axios.create({
   },
 });
 
+let refreshToken: string | null = null;
+let refreshing: Promise<AuthResponse> | null = null;
+let onTokensRefreshed: ((auth: AuthResponse) => void) | null = null;
+
+// /logout accepts the refresh token on its own; refreshing first would revoke
+// the token being logged out and leave the rotated one live
+const NO_REFRESH_URLS = ['/token/refresh', '/logout'];
+
+// Access tokens are short-lived: on a 401, trade the refresh token for a new
+// pair once (shared by concurrent requests) and retry the original request.
+axiosInstance.interceptors.response.use(undefined, async (error) => {
+  const original = error.config;
+  if (error.response?.status !== 401 || !refreshToken || !original || original._retried || NO_REFRESH_URLS.includes(original.url)) {
+    throw error;
+  }
+  original._retried = true;
+
+  if (!refreshing) {
+    refreshing = axiosInstance
+      .post('/token/refresh', { refresh_token: refreshToken })
+      .then((response) => response.data)
+      .finally(() => {
+        refreshing = null;
+      });
+  }
+  const auth = await refreshing;
+  api.setAuthToken(auth.access_token);
+  api.setRefreshToken(auth.refresh_token);
+  onTokensRefreshed?.(auth);
+
+  original.headers = { ...original.headers, Authorization: `Bearer ${auth.access_token}` };
+  return axiosInstance(original);
+});
+
 const api = {
   setAuthToken: (token: string | null) => {
     if (token) {
@@ -20,6 +54,14 @@ const api = {
     }
   },
 
+  setRefreshToken: (token: string | null) => {
+    refreshToken = token;
+  },
+
+  onTokensRefreshed: (callback: ((auth: AuthResponse) => void) | null) => {
+    onTokensRefreshed = callback;
+  },
+
   // Auth
   login: async (username: string, password: string): Promise<AuthResponse> => {
     const response = await axiosInstance.post('/login', { username, password });
@@ -31,6 +73,10 @@ const api = {
     return response.data;
   },
 
+  logout: async (): Promise<void> => {
+    await axiosInstance.post('/logout', { refresh_token: refreshToken });
+  },
+
   // Products
   getProducts: async (): Promise<Product[]> => {
     const response = await axiosInstance.get('/products');
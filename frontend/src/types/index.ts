@@ -37,5 +37,7 @@ export interface Order {
 export interface AuthResponse {
   access_token: string;
   token_type: string;
+  refresh_token: string | null;
+  expires_in: number | null;
   user: User;
 }
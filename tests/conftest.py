@@ -0,0 +1,66 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# server.py reads its configuration at import time
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "lokatani_test")
+os.environ.setdefault("SECRET_KEY", "test-secret")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import server  # noqa: E402
+from repositories import InMemoryRepositories  # noqa: E402
+
+
+@pytest.fixture
+def repos(monkeypatch):
+    fresh = InMemoryRepositories()
+    server.app.dependency_overrides[server.get_repositories] = lambda: fresh
+    # Background jobs and the revocation list use the module-level repositories
+    monkeypatch.setattr(server, "repos", fresh)
+    monkeypatch.setattr(server.revocations, "users", fresh.users)
+    monkeypatch.setattr(server.revocations, "_revoked", {})
+    yield fresh
+    server.app.dependency_overrides.clear()
+
+
+@pytest.fixture
+def client(repos):
+    with TestClient(server.app) as client:
+        yield client
+
+
+@pytest.fixture
+def register(client):
+    def register(username: str, role: str = "buyer"):
+        response = client.post("/api/register", json={
+            "username": username, "password": "secret", "name": username.title(), "phone": "0812", "role": role,
+        })
+        assert response.status_code == 200, response.text
+        return response.json()
+    return register
+
+
+@pytest.fixture
+def login(register):
+    """Registers a user and returns their Authorization headers."""
+    def login(username: str, role: str = "buyer"):
+        return {"Authorization": f"Bearer {register(username, role)['access_token']}"}
+    return login
+
+
+@pytest.fixture
+def create_product(client):
+    def create_product(farmer: dict, name: str = "Cabai Merah", stock=None, price: float = 10000, location="Bogor"):
+        response = client.post("/api/products", headers=farmer, json={
+            "name": name, "description": "Segar", "price": price, "location": location,
+            "image_base64": "", "stock": stock,
+        })
+        assert response.status_code == 200, response.text
+        return response.json()["id"]
+    return create_product
@@ -0,0 +1,62 @@
+import asyncio
+import io
+import random
+from datetime import datetime, timedelta
+
+import pyarrow.parquet as pq
+
+from archive import LocalArchiveStore, OrderArchive, decode_orders, encode_orders, matching_row_groups, partition_key
+
+
+def make_orders(count, buyers, month=6):
+    rng = random.Random(3)
+    return [
+        {
+            "_id": f"o{month:02d}{i:06d}",
+            "buyer_id": f"b{rng.randrange(buyers):05d}",
+            "buyer_name": "Siti",
+            "items": [{"product_id": "p1", "quantity": 2, "price": 5000.0}],
+            "total": 10000.0,
+            "status": "pending",
+            "created_at": datetime(2025, month, 1) + timedelta(minutes=i),
+        }
+        for i in range(count)
+    ]
+
+
+def test_a_buyer_lookup_reads_only_a_few_row_groups():
+    orders = make_orders(20_000, 2000)
+    metadata = pq.ParquetFile(io.BytesIO(encode_orders(orders))).metadata
+
+    assert metadata.num_row_groups == 4
+    assert len(matching_row_groups(metadata, "buyer_id", "b01000")) == 1
+    assert matching_row_groups(metadata, "buyer_id", "zzz") == []
+
+
+def test_decode_orders_filters_by_buyer_and_time():
+    orders = make_orders(20_000, 2000)
+    data = encode_orders(orders)
+    buyer = orders[0]["buyer_id"]
+    start, end = datetime(2025, 6, 2), datetime(2025, 6, 10)
+    expected = {o["_id"] for o in orders if o["buyer_id"] == buyer and start <= o["created_at"] < end}
+
+    found = decode_orders(io.BytesIO(data), buyer, start, end)
+    assert {o["id"] for o in found} == expected
+    assert found[0]["items"] == [{"product_id": "p1", "quantity": 2, "price": 5000.0}]
+    assert len(decode_orders(io.BytesIO(data), buyer, None, None)) > len(expected)
+
+
+def test_read_merges_partitions_and_drops_duplicates(tmp_path):
+    store = LocalArchiveStore(tmp_path)
+    june, july = make_orders(300, 5), make_orders(300, 5, month=7)
+    store.write(partition_key(2025, 6), encode_orders(june))
+    store.write(partition_key(2025, 7), encode_orders(july))
+    # A re-run job wrote part of July again
+    store.write(partition_key(2025, 7).replace("part-", "part-rerun-"), encode_orders(july[:50]))
+
+    archive = OrderArchive(store)
+    buyer = june[0]["buyer_id"]
+    everything = asyncio.run(archive.read(buyer, None, None))
+    assert len(everything) == sum(o["buyer_id"] == buyer for o in june + july)
+    july_only = asyncio.run(archive.read(buyer, datetime(2025, 7, 1), None))
+    assert {o["id"] for o in july_only} == {o["_id"] for o in july if o["buyer_id"] == buyer}
@@ -0,0 +1,91 @@
+from jose import jwt
+
+import server
+
+
+def bearer(token: str):
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_register_and_login_issue_tokens(client, register):
+    register("siti")
+
+    response = client.post("/api/login", json={"username": "siti", "password": "secret"})
+    assert response.status_code == 200
+    auth = response.json()
+    assert auth["user"]["username"] == "siti"
+    assert client.get("/api/me", headers=bearer(auth["access_token"])).json()["username"] == "siti"
+
+    assert client.post("/api/login", json={"username": "siti", "password": "wrong"}).status_code == 401
+
+
+def test_refresh_token_is_not_an_access_token(client, register):
+    auth = register("siti")
+    assert client.get("/api/me", headers=bearer(auth["refresh_token"])).status_code == 401
+
+
+def test_refresh_rotates_and_rejects_reuse(client, register):
+    auth = register("siti")
+
+    rotated = client.post("/api/token/refresh", json={"refresh_token": auth["refresh_token"]})
+    assert rotated.status_code == 200
+    assert client.get("/api/me", headers=bearer(rotated.json()["access_token"])).status_code == 200
+
+    reused = client.post("/api/token/refresh", json={"refresh_token": auth["refresh_token"]})
+    assert reused.status_code == 401
+
+    again = client.post("/api/token/refresh", json={"refresh_token": rotated.json()["refresh_token"]})
+    assert again.status_code == 200
+
+
+def test_refresh_reuse_is_detected_before_the_deny_list_syncs(client, register):
+    auth = register("siti")
+    assert client.post("/api/token/refresh", json={"refresh_token": auth["refresh_token"]}).status_code == 200
+
+    # Another instance that has not synced the revocation yet
+    server.revocations._revoked.clear()
+    reused = client.post("/api/token/refresh", json={"refresh_token": auth["refresh_token"]})
+    assert reused.status_code == 401
+    assert reused.json()["detail"] == "Token has been reused"
+
+
+def test_logout_revokes_both_tokens(client, register):
+    auth = register("siti")
+
+    response = client.post(
+        "/api/logout", json={"refresh_token": auth["refresh_token"]}, headers=bearer(auth["access_token"])
+    )
+    assert response.status_code == 200
+    assert client.get("/api/me", headers=bearer(auth["access_token"])).status_code == 401
+    assert client.post("/api/token/refresh", json={"refresh_token": auth["refresh_token"]}).status_code == 401
+
+
+def test_logout_with_an_expired_access_token_still_revokes_the_refresh_token(client, register):
+    auth = register("siti")
+
+    response = client.post(
+        "/api/logout", json={"refresh_token": auth["refresh_token"]}, headers=bearer("expired.access.token")
+    )
+    assert response.status_code == 200
+    assert client.post("/api/token/refresh", json={"refresh_token": auth["refresh_token"]}).status_code == 401
+
+
+def test_logout_keeps_another_users_refresh_token(client, register):
+    siti, budi = register("siti"), register("budi")
+
+    client.post("/api/logout", json={"refresh_token": budi["refresh_token"]}, headers=bearer(siti["access_token"]))
+    assert client.post("/api/token/refresh", json={"refresh_token": budi["refresh_token"]}).status_code == 200
+
+
+def test_logout_without_a_valid_token_is_rejected(client):
+    assert client.post("/api/logout").status_code == 401
+    assert client.post("/api/logout", json={"refresh_token": "garbage"}).status_code == 401
+
+
+def test_revocations_reach_other_instances_through_sync(client, register, repos):
+    auth = register("siti")
+    client.post("/api/logout", headers=bearer(auth["access_token"]))
+
+    other = server.RevocationList(repos.users)
+    client.portal.call(other.sync)
+    assert jwt.get_unverified_claims(auth["access_token"])["jti"] in other
@@ -0,0 +1,39 @@
+import server
+
+
+def test_batch_runs_sub_requests_as_the_caller(client, login, create_product):
+    farmer, buyer = login("tani", "farmer"), login("siti")
+    product = create_product(farmer, stock=3)
+
+    response = client.post("/api/batch", headers=buyer, json={"requests": [
+        {"id": "me", "path": "/api/me"},
+        {"id": "product", "path": f"/api/products/{product}"},
+        {"id": "add", "method": "POST", "path": "/api/cart/add", "body": {"product_id": product, "quantity": 1}},
+        {"id": "missing", "path": "/api/products/000000000000000000000000"},
+    ]})
+    assert response.status_code == 200
+    responses = {r["id"]: r for r in response.json()["responses"]}
+    assert responses["me"]["status"] == 200 and responses["me"]["body"]["username"] == "siti"
+    assert responses["product"]["body"]["stock"] == 3
+    assert responses["add"]["status"] == 200
+    assert responses["missing"]["status"] == 404
+
+    cart = client.get("/api/cart", headers=buyer).json()
+    assert [item["quantity"] for item in cart["items"]] == [1]
+
+
+def test_batch_sub_requests_needing_auth_fail_on_their_own(client):
+    response = client.post("/api/batch", json={"requests": [{"path": "/api/"}, {"path": "/api/me"}]})
+    assert [r["status"] for r in response.json()["responses"]] == [200, 403]
+
+
+def test_batch_rejects_invalid_requests(client, monkeypatch):
+    def post(*items):
+        return client.post("/api/batch", json={"requests": list(items)}).status_code
+
+    assert post({"path": "/api/batch"}) == 400
+    assert post({"path": "/healthz"}) == 400
+    assert post({"method": "PATCH", "path": "/api/me"}) == 400
+
+    monkeypatch.setattr(server, "BATCH_MAX_REQUESTS", 2)
+    assert post(*[{"path": "/api/"}] * 3) == 400
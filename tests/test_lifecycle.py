@@ -0,0 +1,50 @@
+import asyncio
+import signal
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def raised(monkeypatch):
+    signals = []
+    monkeypatch.setattr(signal, "raise_signal", signals.append)
+    monkeypatch.setattr(server, "lifecycle", server.Lifecycle())
+    monkeypatch.setattr(server, "DRAIN_DELAY", 0.05)
+    server.lifecycle.state = "ready"
+    return signals
+
+
+def test_sigterm_drains_then_raises_one_sigint(raised):
+    async def scenario():
+        server.handle_sigterm()
+        assert server.lifecycle.state == "draining" and raised == []
+        await asyncio.sleep(0.1)
+        # A SIGTERM after the delay must not force-exit uvicorn
+        server.handle_sigterm()
+
+    asyncio.run(scenario())
+    assert raised == [signal.SIGINT]
+
+
+def test_a_second_sigterm_skips_the_delay_once(raised):
+    async def scenario():
+        server.handle_sigterm()
+        server.handle_sigterm()
+        server.handle_sigterm()
+        await asyncio.sleep(0.1)
+
+    asyncio.run(scenario())
+    assert raised == [signal.SIGINT]
+
+
+def test_sigterm_during_shutdown_is_ignored(raised):
+    async def scenario():
+        server.lifecycle.state = "stopping"
+        server.handle_sigterm()
+        await asyncio.sleep(0.1)
+
+    asyncio.run(scenario())
+    assert server.lifecycle.state == "stopping"
+    assert raised == []
@@ -0,0 +1,181 @@
+from datetime import datetime
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def buyer(client, login):
+    headers = login("siti")
+    return headers, client.get("/api/me", headers=headers).json()["id"]
+
+
+def seed(client, repos, buyer_id, created_at, *lines):
+    items = [
+        {"product_id": product_id, "product_name": name, "quantity": quantity, "price": price}
+        for product_id, name, quantity, price in lines
+    ]
+    client.portal.call(repos.orders.create, {
+        "buyer_id": buyer_id, "buyer_name": "Siti", "items": items,
+        "total": sum(item["quantity"] * item["price"] for item in items),
+        "status": "completed", "created_at": created_at,
+    })
+
+
+def test_listing_returns_the_whole_history_by_default(client, repos, buyer):
+    headers, buyer_id = buyer
+    for day in range(1, 29):
+        for hour in range(3):
+            seed(client, repos, buyer_id, datetime(2026, 2, day, hour), ("p1", "Cabai", 1, 1000))
+
+    orders = client.get("/api/orders", headers=headers).json()
+    assert len(orders) == 84
+    assert orders[0]["created_at"] > orders[-1]["created_at"]
+
+
+def test_listing_sorts_pages_and_filters_by_range(client, repos, buyer):
+    headers, buyer_id = buyer
+    for day, total in [(1, 3), (2, 1), (3, 2)]:
+        seed(client, repos, buyer_id, datetime(2026, 3, day), ("p1", "Cabai", 1, total))
+
+    by_total = client.get("/api/orders", headers=headers, params={"sort": "total"}).json()
+    assert [o["total"] for o in by_total] == [1, 2, 3]
+    page = client.get("/api/orders", headers=headers, params={"sort": "total", "skip": 1, "limit": 1}).json()
+    assert [o["total"] for o in page] == [2]
+    ranged = client.get("/api/orders", headers=headers, params={"start": "2026-03-02T00:00:00Z"}).json()
+    assert [o["total"] for o in ranged] == [2, 1]
+    assert client.get("/api/orders", headers=headers, params={"sort": "buyer_name"}).status_code == 400
+
+
+@pytest.fixture
+def archived(repos, buyer, monkeypatch):
+    # Orders before 2026 have been moved to the archive
+    _, buyer_id = buyer
+    orders = [
+        {"id": f"old-{month}", "buyer_id": buyer_id, "buyer_name": "Siti", "status": "completed",
+         "items": [{"product_id": "p1", "product_name": "Cabai", "quantity": 1, "price": 1000}],
+         "total": 1000, "created_at": datetime(2025, month, 1)}
+        for month in (11, 12)
+    ]
+    reads = []
+
+    async def read(buyer, start, end):
+        reads.append((start, end))
+        return [o for o in orders if o["buyer_id"] == buyer and (start is None or o["created_at"] >= start)]
+
+    async def archived_before():
+        return datetime(2026, 1, 1)
+
+    monkeypatch.setattr(repos.orders, "archived_before", archived_before)
+    monkeypatch.setattr(server.order_archive, "read", read)
+    return reads
+
+
+def test_default_reads_include_archived_orders(client, repos, buyer, archived):
+    headers, buyer_id = buyer
+    seed(client, repos, buyer_id, datetime(2026, 2, 1), ("p1", "Cabai", 2, 1000))
+
+    orders = client.get("/api/orders", headers=headers).json()
+    assert [o["id"] for o in orders][1:] == ["old-12", "old-11"]
+    summary = client.get("/api/orders", headers=headers, params={"summary": "true"}).json()
+    assert (summary["order_count"], summary["total_spent"], summary["item_count"]) == (3, 4000, 4)
+    assert archived == [(None, datetime(2026, 1, 1))] * 2
+
+
+def test_reads_that_do_not_need_the_archive_skip_it(client, repos, buyer, archived):
+    headers, buyer_id = buyer
+    seed(client, repos, buyer_id, datetime(2026, 2, 1), ("p1", "Cabai", 2, 1000))
+    seed(client, repos, buyer_id, datetime(2026, 2, 2), ("p1", "Cabai", 2, 1000))
+
+    assert len(client.get("/api/orders", headers=headers, params={"limit": 2}).json()) == 2
+    assert len(client.get("/api/orders", headers=headers, params={"start": "2026-01-15T00:00:00Z"}).json()) == 2
+    assert archived == []
+
+
+def test_summary_totals_periods_and_top_products(client, repos, buyer):
+    headers, buyer_id = buyer
+    seed(client, repos, buyer_id, datetime(2026, 1, 10), ("p1", "Cabai", 2, 1000), ("p2", "Tomat", 1, 500))
+    seed(client, repos, buyer_id, datetime(2026, 2, 5), ("p2", "Tomat", 4, 500))
+    seed(client, repos, "someone-else", datetime(2026, 2, 5), ("p3", "Bawang", 9, 100))
+
+    summary = client.get("/api/orders", headers=headers, params={"summary": "true", "top": 1}).json()
+    assert summary["order_count"] == 2
+    assert summary["item_count"] == 7
+    assert summary["total_spent"] == 4500
+    assert summary["first_order_at"].startswith("2026-01-10")
+    assert summary["spend_by_period"] == [
+        {"period": "2026-01", "order_count": 1, "total_spent": 2500},
+        {"period": "2026-02", "order_count": 1, "total_spent": 2000},
+    ]
+    assert summary["top_products"] == [{"product_id": "p2", "product_name": "Tomat", "quantity": 5, "total_spent": 2500}]
+
+
+def test_summary_periods_follow_the_time_zone(client, repos, buyer):
+    headers, buyer_id = buyer
+    # 01:00 on 1 February in Jakarta (UTC+7)
+    seed(client, repos, buyer_id, datetime(2026, 1, 31, 18), ("p1", "Cabai", 1, 1000))
+
+    params = {"summary": "true", "period": "month"}
+    utc = client.get("/api/orders", headers=headers, params=params).json()
+    jakarta = client.get("/api/orders", headers=headers, params={**params, "tz": "Asia/Jakarta"}).json()
+    assert [row["period"] for row in utc["spend_by_period"]] == ["2026-01"]
+    assert [row["period"] for row in jakarta["spend_by_period"]] == ["2026-02"]
+
+    response = client.get("/api/orders", headers=headers, params={**params, "tz": "Mars/Olympus"})
+    assert response.status_code == 400
+
+
+def test_empty_summary(client, buyer):
+    headers, _ = buyer
+    summary = client.get("/api/orders", headers=headers, params={"summary": "true"}).json()
+    assert (summary["order_count"], summary["spend_by_period"], summary["top_products"]) == (0, [], [])
+
+
+def test_orders_store_numeric_quantities(client, login, create_product):
+    farmer, headers = login("tani", "farmer"), login("siti")
+    product = create_product(farmer, stock=5)
+
+    response = client.post("/api/orders", headers=headers, json={
+        "items": [{"product_id": product, "product_name": "Cabai Merah", "quantity": "2", "price": "10000"}],
+        "total": 20000,
+    })
+    assert response.status_code == 200
+    assert response.json()["items"][0]["quantity"] == 2
+
+    summary = client.get("/api/orders", headers=headers, params={"summary": "true"}).json()
+    assert summary["item_count"] == 2
+    assert summary["top_products"][0]["total_spent"] == 20000
+
+
+def test_orders_without_a_price_still_summarize(client, repos, buyer, login, create_product):
+    headers, buyer_id = buyer
+    product = create_product(login("tani", "farmer"), stock=5)
+
+    response = client.post("/api/orders", headers=headers, json={
+        "items": [{"product_id": product, "quantity": 1, "price": None}], "total": 0,
+    })
+    assert response.status_code == 200
+    assert "price" not in response.json()["items"][0]
+    # Archived orders written before this fix may still carry a null price
+    client.portal.call(repos.orders.create, {
+        "buyer_id": buyer_id, "buyer_name": "Siti", "total": 0, "status": "completed",
+        "items": [{"product_id": "p1", "quantity": 2, "price": None}], "created_at": datetime(2026, 1, 1),
+    })
+
+    summary = client.get("/api/orders", headers=headers, params={"summary": "true"}).json()
+    assert summary["item_count"] == 3
+    assert {row["product_id"]: row["total_spent"] for row in summary["top_products"]} == {product: 0, "p1": 0}
+
+
+@pytest.mark.parametrize("item", [{"product_id": "nope", "quantity": 1}, {"quantity": 1}])
+def test_orders_reject_invalid_items(client, login, item):
+    response = client.post("/api/orders", headers=login("siti"), json={"items": [item], "total": 0})
+    assert response.status_code == 400
+
+
+def test_only_buyers_can_order(client, login, create_product):
+    farmer = login("tani", "farmer")
+    product = create_product(farmer, stock=5)
+    response = client.post("/api/orders", headers=farmer, json={"items": [{"product_id": product, "quantity": 1}], "total": 0})
+    assert response.status_code == 403
@@ -0,0 +1,53 @@
+from datetime import datetime
+
+import numpy as np
+
+from price_history import downsample
+
+
+def series(*points):
+    times = np.array([t for t, _ in points], dtype="datetime64[ms]")
+    prices = np.array([p for _, p in points], dtype=np.float64)
+    return times, prices
+
+
+def ohlc(row):
+    return row["open"], row["high"], row["low"], row["close"]
+
+
+def test_downsample_buckets_carry_the_price_forward():
+    times, prices = series(
+        (datetime(2026, 5, 31, 23), 10),  # in effect at start
+        (datetime(2026, 6, 1, 0, 30), 12),
+        (datetime(2026, 6, 1, 0, 45), 8),
+        (datetime(2026, 6, 1, 2, 10), 15),
+    )
+    rows = downsample(times, prices, datetime(2026, 6, 1), datetime(2026, 6, 1, 4), 4)
+
+    assert [row["t"] for row in rows] == [datetime(2026, 6, 1, hour) for hour in range(4)]
+    assert ohlc(rows[0]) == (10, 12, 8, 8)
+    assert ohlc(rows[1]) == (8, 8, 8, 8)
+    # A change part-way through opens at the previous close
+    assert ohlc(rows[2]) == (8, 15, 8, 15)
+    assert ohlc(rows[3]) == (15, 15, 15, 15)
+
+
+def test_downsample_starts_at_the_first_known_price():
+    times, prices = series((datetime(2026, 6, 1, 1, 30), 5))
+    rows = downsample(times, prices, datetime(2026, 6, 1), datetime(2026, 6, 1, 2), 2)
+    assert [(row["t"], ohlc(row)) for row in rows] == [(datetime(2026, 6, 1, 1), (5, 5, 5, 5))]
+
+
+def test_downsample_never_returns_more_than_the_requested_points():
+    times, prices = series(*((datetime(2026, 6, 1, 0, minute), minute) for minute in range(60)))
+    rows = downsample(times, prices, datetime(2026, 6, 1), datetime(2026, 6, 1, 1), 7)
+    assert len(rows) == 7
+    assert rows[0]["open"] == 0 and rows[-1]["close"] == 59
+    assert max(row["high"] for row in rows) == 59
+
+
+def test_downsample_empty_inputs():
+    times, prices = series()
+    assert downsample(times, prices, datetime(2026, 6, 1), datetime(2026, 6, 2), 10) == []
+    times, prices = series((datetime(2026, 6, 1), 1))
+    assert downsample(times, prices, datetime(2026, 6, 2), datetime(2026, 6, 1), 10) == []
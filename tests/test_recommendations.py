@@ -0,0 +1,49 @@
+import random
+from collections import Counter
+
+import numpy as np
+
+from recommendations import count_copurchases, merge_counts, top_neighbours
+
+
+def as_counter(rows, cols, counts):
+    return Counter({(int(r), int(c)): int(n) for r, c, n in zip(rows, cols, counts)})
+
+
+def brute_force(baskets):
+    pairs = Counter()
+    for basket in baskets:
+        for a in basket:
+            for b in basket:
+                if a != b:
+                    pairs[(int(a), int(b))] += 1
+    return pairs
+
+
+def test_count_copurchases_matches_pairwise_counting():
+    rng = random.Random(7)
+    baskets = [np.array(rng.sample(range(30), rng.randint(1, 6))) for _ in range(200)]
+    assert as_counter(*count_copurchases(baskets, 30)) == brute_force(baskets)
+
+
+def test_count_copurchases_is_symmetric_and_skips_the_diagonal():
+    rows, cols, counts = count_copurchases([np.array([0, 1, 2]), np.array([1, 2]), np.array([3])], 4)
+    pairs = as_counter(rows, cols, counts)
+    assert pairs == {(0, 1): 1, (0, 2): 1, (1, 0): 1, (2, 0): 1, (1, 2): 2, (2, 1): 2}
+
+
+def test_count_copurchases_without_baskets():
+    rows, cols, counts = count_copurchases([], 10)
+    assert len(rows) == len(cols) == len(counts) == 0
+
+
+def test_merge_counts_sums_batches():
+    first = [np.array([0, 1]), np.array([0, 1, 2])]
+    second = [np.array([1, 2])]
+    merged = merge_counts([count_copurchases(first, 3), count_copurchases(second, 3)], 3)
+    assert as_counter(*merged) == brute_force(first + second)
+
+
+def test_top_neighbours_orders_by_count():
+    neighbours = top_neighbours({"a": 3, "b": 5, "c": 1, "d": 3}, 3)
+    assert neighbours == [{"product_id": "b", "count": 5}, {"product_id": "d", "count": 3}, {"product_id": "a", "count": 3}]
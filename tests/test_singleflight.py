@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from server import SingleFlight
+
+
+def test_concurrent_calls_share_one_load():
+    flight = SingleFlight("test")
+    loads = []
+
+    async def load():
+        loads.append(1)
+        await asyncio.sleep(0.01)
+        return {"name": "Cabai"}
+
+    async def scenario():
+        return await asyncio.gather(*(flight.do("p1", load) for _ in range(5)))
+
+    results = asyncio.run(scenario())
+    assert len(loads) == 1
+    assert all(result is results[0] for result in results)
+    assert (flight.calls, flight.executions) == (5, 1)
+
+
+def test_different_keys_load_separately():
+    flight = SingleFlight("test")
+
+    async def scenario():
+        return await asyncio.gather(flight.do("a", lambda: asyncio.sleep(0, "a")), flight.do("b", lambda: asyncio.sleep(0, "b")))
+
+    assert asyncio.run(scenario()) == ["a", "b"]
+    assert flight.executions == 2
+
+
+def test_errors_are_shared_and_not_cached():
+    flight = SingleFlight("test")
+    attempts = []
+
+    async def failing():
+        attempts.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("database down")
+
+    async def scenario():
+        results = await asyncio.gather(*(flight.do("p1", failing) for _ in range(3)), return_exceptions=True)
+        # The failed load is forgotten; the next caller tries again
+        retry = await flight.do("p1", lambda: asyncio.sleep(0, "ok"))
+        return results, retry
+
+    results, retry = asyncio.run(scenario())
+    assert len(attempts) == 1
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert retry == "ok"
+    assert flight.errors == 1
+
+
+def test_a_hung_load_times_out_and_is_forgotten():
+    flight = SingleFlight("test", timeout=0.05)
+    cancelled = []
+
+    async def hung():
+        try:
+            await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def scenario():
+        results = await asyncio.gather(*(flight.do("p1", hung) for _ in range(3)), return_exceptions=True)
+        # The next caller starts a fresh load instead of joining the dead one
+        return results, await flight.do("p1", lambda: asyncio.sleep(0, "ok"))
+
+    results, retry = asyncio.run(scenario())
+    assert all(isinstance(r, asyncio.TimeoutError) for r in results)
+    assert retry == "ok"
+    assert cancelled == [1]
+    assert (flight.executions, flight.timeouts, flight.errors) == (2, 1, 0)
+    assert flight.stats()["in_flight"] == 0
@@ -0,0 +1,174 @@
+import asyncio
+from datetime import datetime
+
+import mongomock
+import pytest
+
+import server
+from repositories import unreserved_at_least
+
+
+def add_to_cart(client, buyer, product_id, quantity):
+    return client.post("/api/cart/add", headers=buyer, json={"product_id": product_id, "quantity": quantity})
+
+
+def order(client, buyer, *lines):
+    items = [{"product_id": product_id, "quantity": quantity, "price": 10000} for product_id, quantity in lines]
+    return client.post("/api/orders", headers=buyer, json={"items": items, "total": 10000 * len(items)})
+
+
+def stock(client, repos, product_id):
+    product = client.portal.call(repos.products.get, product_id)
+    return product["stock"], product.get("reserved", 0)
+
+
+def test_another_buyers_hold_blocks_a_direct_order(client, repos, login, create_product):
+    farmer, alice, bob = login("tani", "farmer"), login("alice"), login("bob")
+    product = create_product(farmer, stock=5)
+
+    assert add_to_cart(client, alice, product, 5).status_code == 200
+    assert order(client, bob, (product, 5)).status_code == 409
+    assert add_to_cart(client, bob, product, 1).status_code == 409
+
+    assert order(client, alice, (product, 5)).status_code == 200
+    assert stock(client, repos, product) == (0, 0)
+
+
+def test_checkout_consumes_only_the_buyers_own_hold(client, repos, login, create_product):
+    farmer, alice, bob = login("tani", "farmer"), login("alice"), login("bob")
+    product = create_product(farmer, stock=10)
+    add_to_cart(client, alice, product, 4)
+    add_to_cart(client, bob, product, 3)
+
+    # Ordering less than held gives the rest of the hold back
+    assert order(client, alice, (product, 2)).status_code == 200
+    assert stock(client, repos, product) == (8, 3)
+
+    # Bob may take his own 3 plus the 5 nobody holds
+    assert order(client, bob, (product, 9)).status_code == 409
+    assert order(client, bob, (product, 8)).status_code == 200
+    assert stock(client, repos, product) == (0, 0)
+
+
+def test_failed_checkout_keeps_stock_and_holds(client, repos, login, create_product):
+    farmer, alice = login("tani", "farmer"), login("alice")
+    held = create_product(farmer, "Bawang", stock=2)
+    short = create_product(farmer, "Tomat", stock=1)
+    add_to_cart(client, alice, held, 2)
+
+    assert order(client, alice, (held, 2), (short, 2)).status_code == 409
+    assert stock(client, repos, held) == (2, 2)
+    assert stock(client, repos, short) == (1, 0)
+    assert order(client, alice, (held, 2)).status_code == 200
+
+
+def test_removing_and_clearing_the_cart_release_holds(client, repos, login, create_product):
+    farmer, alice = login("tani", "farmer"), login("alice")
+    first = create_product(farmer, "Bawang", stock=3)
+    second = create_product(farmer, "Tomat", stock=3)
+    add_to_cart(client, alice, first, 2)
+    add_to_cart(client, alice, second, 3)
+
+    client.delete(f"/api/cart/remove/{first}", headers=alice)
+    assert stock(client, repos, first) == (3, 0)
+    assert stock(client, repos, second) == (3, 3)
+
+    client.post("/api/cart/clear", headers=alice)
+    assert stock(client, repos, second) == (3, 0)
+
+
+def test_expired_holds_are_given_back(client, repos, login, create_product, monkeypatch):
+    farmer, alice, bob = login("tani", "farmer"), login("alice"), login("bob")
+    product = create_product(farmer, stock=2)
+    monkeypatch.setattr(server, "RESERVATION_TTL_MINUTES", -1)
+    add_to_cart(client, alice, product, 2)
+    assert add_to_cart(client, bob, product, 1).status_code == 409
+
+    assert client.portal.call(server.release_expired_holds) == 1
+    assert stock(client, repos, product) == (2, 0)
+    assert add_to_cart(client, bob, product, 1).status_code == 200
+
+
+def test_a_checkout_that_dies_midway_leaves_its_holds_to_the_sweeper(client, repos, login, create_product, monkeypatch):
+    farmer, alice = login("tani", "farmer"), login("alice")
+    product = create_product(farmer, stock=4)
+    add_to_cart(client, alice, product, 3)
+    alice_id = client.get("/api/me", headers=alice).json()["id"]
+
+    # The checkout claimed the holds, then its process went away
+    held = client.portal.call(repos.carts.claim, alice_id, "dead-checkout", datetime.utcnow())
+    assert list(held) == [product]
+    # A second checkout cannot count the claimed hold as its own
+    assert order(client, alice, (product, 3)).status_code == 409
+
+    assert client.portal.call(server.release_expired_holds) == 0
+    monkeypatch.setattr(server, "CHECKOUT_CLAIM_SECONDS", -1)
+    assert client.portal.call(server.release_expired_holds) == 1
+    assert stock(client, repos, product) == (4, 0)
+
+
+def test_a_failed_order_insert_keeps_stock_and_holds(client, repos, login, create_product, monkeypatch):
+    farmer, alice = login("tani", "farmer"), login("alice")
+    product = create_product(farmer, stock=2)
+    add_to_cart(client, alice, product, 2)
+
+    create = repos.orders.create
+    failures = [RuntimeError("database down")]
+
+    async def flaky(order):
+        if failures:
+            raise failures.pop()
+        return await create(order)
+
+    monkeypatch.setattr(repos.orders, "create", flaky)
+    with pytest.raises(RuntimeError):
+        order(client, alice, (product, 2))
+    assert stock(client, repos, product) == (2, 2)
+
+    assert order(client, alice, (product, 2)).status_code == 200
+    assert stock(client, repos, product) == (0, 0)
+
+
+def test_untracked_stock_is_never_held_or_short(client, repos, login, create_product):
+    farmer, alice = login("tani", "farmer"), login("alice")
+    product = create_product(farmer, stock=None)
+
+    assert add_to_cart(client, alice, product, 100).status_code == 200
+    assert order(client, alice, (product, 100)).status_code == 200
+    assert stock(client, repos, product) == (None, 0)
+
+
+def test_reservations_stop_at_unreserved_stock(repos):
+    async def scenario():
+        product_id = await repos.products.create({"name": "Cabai", "stock": 5})
+        results = [await repos.products.reserve(product_id, 1) for _ in range(7)]
+        taken = await repos.products.take_stock(product_id, 1)
+        return results, taken, await repos.products.get(product_id)
+
+    results, taken, product = asyncio.run(scenario())
+    assert results.count(True) == 5
+    assert not taken
+    assert (product["stock"], product["reserved"]) == (5, 5)
+
+
+def test_the_conditional_update_filter():
+    # MongoDB applies filter and $inc to one document atomically, so racing
+    # reservations are safe exactly when this filter refuses the last unit
+    products = mongomock.MongoClient().db.products
+    products.insert_many([
+        {"_id": "held", "stock": 5, "reserved": 3},
+        {"_id": "legacy", "stock": 5},  # written before migration 5
+        {"_id": "untracked", "stock": None, "reserved": 0},
+    ])
+
+    def matching(quantity):
+        return sorted(doc["_id"] for doc in products.find({"$expr": unreserved_at_least(quantity)}))
+
+    assert matching(2) == ["held", "legacy"]
+    assert matching(3) == ["legacy"]
+    assert matching(6) == []
+
+    reserved = 0
+    while products.update_one({"_id": "legacy", "$expr": unreserved_at_least(2)}, {"$inc": {"reserved": 2}}).modified_count:
+        reserved += 2
+    assert reserved == 4
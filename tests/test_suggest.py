@@ -0,0 +1,86 @@
+import server
+from suggest import SuggestionIndex, normalize
+
+
+def texts(results):
+    return [r["text"] for r in results]
+
+
+def test_normalize_folds_case_accents_and_spaces():
+    assert normalize("  Cabai   MERAH ") == "cabai merah"
+    assert normalize("Jéruk Médan") == "jeruk medan"
+
+
+def test_any_word_of_a_term_matches():
+    index = SuggestionIndex()
+    index.load([("product", "Cabai Merah", 1), ("product", "Bawang Merah", 1), ("location", "Bogor", 1)])
+
+    # Equal weights: the shorter term first
+    assert texts(index.suggest("merah")) == ["Cabai Merah", "Bawang Merah"]
+    assert texts(index.suggest("bawang m")) == ["Bawang Merah"]
+    assert texts(index.suggest("Bo")) == ["Bogor"]
+    assert index.suggest("xyz") == [] and index.suggest("   ") == []
+
+
+def test_ranking_covers_every_match_of_a_short_prefix():
+    index = SuggestionIndex()
+    # The popular term sorts after thousands of others with the same first letter
+    index.load([("product", f"cabai {i:05d}", 1) for i in range(5000)] + [("product", "Cumi", 40)])
+
+    results = index.suggest("c", limit=3)
+    assert results[0] == {"text": "Cumi", "type": "product", "weight": 40}
+    assert len(results) == 3
+
+
+def test_weights_of_the_same_term_add_up():
+    index = SuggestionIndex()
+    index.load([("product", "Cabai", 3), ("product", "cabai ", 4), ("product", "Cumi", 5)])
+    assert index.suggest("c") == [
+        {"text": "Cabai", "type": "product", "weight": 7},
+        {"text": "Cumi", "type": "product", "weight": 5},
+    ]
+
+
+def test_kind_filter_and_limit():
+    index = SuggestionIndex()
+    index.load([("product", "Bogor Manis", 1), ("location", "Bogor", 3), ("location", "Bandung", 2)])
+
+    assert texts(index.suggest("b", kind="location")) == ["Bogor", "Bandung"]
+    assert texts(index.suggest("bo", kind="product")) == ["Bogor Manis"]
+    assert len(index.suggest("b", limit=1)) == 1
+
+
+def test_add_and_remove_update_cached_rankings():
+    index = SuggestionIndex()
+    index.load([("product", "Cabai", 2), ("product", "Cumi", 1)])
+    assert texts(index.suggest("c")) == ["Cabai", "Cumi"]
+
+    index.add("product", "Cumi", weight=5)
+    assert texts(index.suggest("c")) == ["Cumi", "Cabai"]
+
+    index.remove("product", "Cumi", weight=6)
+    assert texts(index.suggest("c")) == ["Cabai"]
+    assert texts(index.suggest("cu")) == []
+    assert len(index) == 1
+
+
+def test_ordered_products_rank_first(client, repos, login, create_product, monkeypatch):
+    monkeypatch.setattr(server, "product_suggestions", SuggestionIndex())
+    farmer, buyer = login("tani", "farmer"), login("siti")
+    create_product(farmer, "Cabai", location="Bogor")
+    cumi = create_product(farmer, "Cumi Segar", location="Cianjur")
+
+    def suggest(q, kind):
+        return texts(client.get("/api/products/suggest", params={"q": q, "type": kind}).json())
+
+    assert suggest("c", "product") == ["Cabai", "Cumi Segar"]
+    for _ in range(2):
+        client.post("/api/orders", headers=buyer, json={"items": [{"product_id": cumi, "quantity": 1}], "total": 0})
+    assert suggest("c", "product") == ["Cumi Segar", "Cabai"]
+    assert suggest("c", "location") == ["Cianjur"]
+
+    # The periodic rebuild reads the same counts back from storage
+    client.portal.call(server.rebuild_suggestions)
+    assert client.get("/api/products/suggest", params={"q": "cu"}).json()[0] == {
+        "text": "Cumi Segar", "type": "product", "weight": 3,
+    }